@@ -0,0 +1,423 @@
+# Benchmarks every stage of the generation on synthetic timetables.
+#
+#   python benchmark.py --weeks 16 32 --groups 18 --output results.json
+#   python benchmark.py --compare results.json
+#   python benchmark.py --memory 1000 10000 30000
+#
+# Each stage is timed (best of `--repeat` runs) and its peak memory measured,
+# and the results are saved as JSON. With `--compare`, the results are
+# checked against a previous JSON file and the stages slower than
+# `--tolerance` are reported as regressions. With `--memory`, the peak
+# memory of streaming a calendar is measured for collometres of the given
+# numbers of colleurs instead, and must not grow with them.
+
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import tracemalloc
+
+from datetime import datetime, time, timedelta
+from time import perf_counter
+
+import csv_to_ical
+
+
+DAY_NAMES = ["Lu", "Ma", "Me", "Je", "Ve"]
+SUBJECTS = ["Maths", "Physique", "Info", "Anglais", "Francais", "Chimie"]
+
+
+# Writes a set of 0.csv, 1.csv, 2.csv, room.csv, ds.csv and collometre.csv
+# in `directory`, and returns the END_TIME_MAP of its slots
+def write_synthetic_timetable(
+        directory,
+        weeks=16,
+        groups=18,
+        slots_per_day=10,
+        colleurs=20,
+        seed=0
+):
+    rng = random.Random(seed)
+
+    # Slots from 8:00 to 18:00, each ending 5 minutes before the next one
+    slot_length = 600 // slots_per_day
+    slot_times = [
+        datetime(2000, 1, 1, 8) + timedelta(minutes=slot * slot_length)
+        for slot in range(slots_per_day)
+    ]
+    slot_names = [slot_time.strftime("%H:%M") for slot_time in slot_times]
+    end_time_map = {
+        slot_name: (slot_time - timedelta(minutes=5)).time()
+        for slot_name, slot_time in zip(slot_names, slot_times)
+    }
+    end_time_map["last_hour"] = time(18, 15)
+
+    header = ["Horaire", "Lu", "Ma", "Me", "Je", "Ve", "Sa"]
+
+    for groupe_changeant_index in range(csv_to_ical.GROUP_COUNT):
+        rows = [header]
+        for slot_name in slot_names:
+            rows.append([slot_name] + [
+                rng.choice(SUBJECTS) + "@S" + str(rng.randint(1, 30))
+                if rng.random() < 0.7 else ""
+                for _ in range(csv_to_ical.DAYS_IN_WEEK)
+            ])
+        _write_csv(directory, f"{groupe_changeant_index}.csv", rows)
+
+    rows = [header]
+    for slot_name in slot_names:
+        rows.append([slot_name] + [
+            rng.choice(["1", "2", "3", "", ""])
+            for _ in range(csv_to_ical.DAYS_IN_WEEK)
+        ])
+    _write_csv(directory, "room.csv", rows)
+
+    rows = [["Semaine", "Lundi", "DS lundi", "DS mercredi", "DS samedi"]]
+    grid = csv_to_ical.AcademicGrid(
+            csv_to_ical.START_DATE,
+            weeks,
+            csv_to_ical.VACATION_STARTING_WEEKS,
+            csv_to_ical.VACATION_LENGTHS
+    )
+    for week in range(weeks):
+        monday = grid.get_date(week, 0).strftime("%d/%m/%y")
+        rows.append([str(week), monday] + [
+            rng.choice(SUBJECTS) if rng.random() < 0.3 else ""
+            for _ in range(3)
+        ])
+    _write_csv(directory, "ds.csv", rows)
+
+    rows = [
+        ["Colleur", "Horaire", "Salle"] + [str(week) for week in range(weeks)]
+    ]
+    for colleur in range(colleurs):
+        if colleur % 5 == 0:
+            rows.append([rng.choice(SUBJECTS), "", ""] + [""] * weeks)
+
+        # A colleur has several slots in large collometres, as in real ones
+        start = rng.randint(8, 18)
+        rows.append([
+            f"M. Colleur{colleur % 200}",
+            f"{rng.choice(DAY_NAMES)} {start}-{start + 1}",
+            f"S{rng.randint(1, 30)}",
+        ] + [
+            "+".join(
+                str(rng.randint(1, groups)) for _ in range(rng.randint(1, 2))
+            ) if rng.random() < 0.8 else ""
+            for _ in range(weeks)
+        ])
+    _write_csv(directory, "collometre.csv", rows)
+
+    return end_time_map
+
+
+def _write_csv(directory, filename, rows):
+    with open(
+            os.path.join(directory, filename),
+            'w',
+            newline='',
+            encoding='utf-8'
+    ) as csvfile:
+        csv.writer(csvfile).writerows(rows)
+
+
+# Returns the best time out of `repeat` runs and the peak memory of one more
+# run traced by tracemalloc
+def measure(function, repeat=3):
+    best_time = None
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"seconds": best_time, "peak_memory_kb": peak_memory // 1024}
+
+
+# Benchmarks every stage on a synthetic timetable of the given size
+def run_benchmark(weeks, groups, slots_per_day, colleurs, repeat=3):
+    with _synthetic_timetable(weeks, groups, slots_per_day, colleurs):
+        return _run_stages(groups, repeat)
+
+
+# Returns the peak memory in Ko of streaming the calendar of a colle group
+# for every number of colleurs of `colleur_counts`
+def measure_streaming_memory(colleur_counts, weeks=16, groups=18):
+    peak_memories = {}
+
+    for colleurs in colleur_counts:
+        with _synthetic_timetable(weeks, groups, 10, colleurs):
+            lesson_plannings = csv_to_ical.parse_csv_schedule()
+            static_group = csv_to_ical._get_static_group(1)
+
+            def stream_calendar():
+                csv_to_ical.write_calendar_stream(
+                        csv_to_ical.iter_calendar_events(
+                            include_colles=True,
+                            include_schedule=True,
+                            colle_planning=csv_to_ical.iter_colles(1),
+                            lesson_plannings=lesson_plannings,
+                            static_group=static_group,
+                            include_lv2=True,
+                            include_ds=True,
+                            ds_planning=csv_to_ical.iter_ds_weeks()
+                        ),
+                        "stream.ics"
+                )
+
+            # Fills the caches that don't depend on the input size
+            stream_calendar()
+            peak_memories[colleurs] = measure(stream_calendar, 1)[
+                "peak_memory_kb"
+            ]
+
+    return peak_memories
+
+
+# Writes a synthetic timetable in a temporary directory and runs the body in
+# it, with the settings of the timetable and without the progress prints
+@contextlib.contextmanager
+def _synthetic_timetable(weeks, groups, slots_per_day, colleurs):
+    with tempfile.TemporaryDirectory() as directory:
+        end_time_map = write_synthetic_timetable(
+                directory,
+                weeks,
+                groups,
+                slots_per_day,
+                colleurs
+        )
+
+        previous_directory = os.getcwd()
+        previous_settings = (
+            csv_to_ical.WEEK_COUNT,
+            csv_to_ical.COLLE_GROUPS,
+            csv_to_ical.END_TIME_MAP,
+        )
+        os.chdir(directory)
+        csv_to_ical.WEEK_COUNT = weeks
+        csv_to_ical.COLLE_GROUPS = range(1, groups + 1)
+        csv_to_ical.END_TIME_MAP = end_time_map
+
+        try:
+            # The generation prints progress that should not be measured
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield directory
+        finally:
+            os.chdir(previous_directory)
+            (
+                csv_to_ical.WEEK_COUNT,
+                csv_to_ical.COLLE_GROUPS,
+                csv_to_ical.END_TIME_MAP,
+            ) = previous_settings
+
+
+def _run_stages(groups, repeat):
+    lesson_plannings = csv_to_ical.parse_csv_schedule()
+    room_planning = csv_to_ical.parse_room_schedule()
+    ds_planning = csv_to_ical.parse_csv_ds()
+    colle_schedule = csv_to_ical.parse_collometre(1)
+
+    def get_calendar():
+        return csv_to_ical.get_calendar(
+                include_colles=True,
+                include_schedule=True,
+                include_room_schedule=True,
+                colle_planning=colle_schedule,
+                lesson_plannings=lesson_plannings,
+                room_planning=room_planning,
+                static_group=csv_to_ical._get_static_group(1),
+                include_lv2=True,
+                include_ds=True,
+                ds_planning=ds_planning
+        )
+
+    def iter_calendar_events():
+        return csv_to_ical.iter_calendar_events(
+                True,
+                True,
+                True,
+                colle_schedule,
+                lesson_plannings,
+                room_planning,
+                csv_to_ical._get_static_group(1),
+                include_lv2=True,
+                include_ds=True,
+                ds_planning=ds_planning
+        )
+
+    # Lessons, room and LV2 of every static group, without colles nor DS
+    def expand_weeks():
+        for static_group in csv_to_ical.STATIC_GROUPS:
+            for _ in csv_to_ical.iter_calendar_events(
+                    False,
+                    True,
+                    True,
+                    None,
+                    lesson_plannings,
+                    room_planning,
+                    static_group,
+                    include_lv2=True
+            ):
+                pass
+
+    calendar = get_calendar()
+    jobs = [
+        {
+            "colle_group": colle_group,
+            "output_filename": f"schedule_{colle_group}.ics",
+            "include_colles": True,
+            "include_schedule": True,
+            "include_room_planning": True,
+            "include_lv2": True,
+        }
+        for colle_group in range(1, groups + 1)
+    ]
+
+    stages = {
+        "parse_csv_schedule": csv_to_ical.parse_csv_schedule,
+        "parse_room_schedule": csv_to_ical.parse_room_schedule,
+        "parse_csv_ds": csv_to_ical.parse_csv_ds,
+        "build_collometre_index": csv_to_ical.build_collometre_index,
+        "parse_collometre": lambda: csv_to_ical.parse_collometre(1),
+        "build_events": lambda: list(iter_calendar_events()),
+        "expand_weeks": expand_weeks,
+        "get_calendar": get_calendar,
+        "to_ical": calendar.to_ical,
+        "write_calendar_stream": lambda: csv_to_ical.write_calendar_stream(
+                iter_calendar_events(),
+                "stream.ics"
+        ),
+        "generate_batch": lambda: csv_to_ical.generate_batch(jobs),
+        # After generate_batch, which would otherwise load the bundle
+        "compile_bundle": csv_to_ical.compile_bundle,
+        "load_bundle": lambda: csv_to_ical.load_bundle(colle_groups=None),
+    }
+
+    return {
+        name: measure(function, repeat) for name, function in stages.items()
+    }
+
+
+# Returns the stages of `results` slower than in `previous` by more than
+# `tolerance` (0.2 is 20%), as (configuration, stage, previous, current)
+def find_regressions(previous, results, tolerance=0.2):
+    previous_runs = {
+        json.dumps(run["config"], sort_keys=True): run["stages"]
+        for run in previous["runs"]
+    }
+
+    regressions = []
+    for run in results["runs"]:
+        config = json.dumps(run["config"], sort_keys=True)
+        if config not in previous_runs:
+            continue
+
+        for stage, result in run["stages"].items():
+            previous_result = previous_runs[config].get(stage)
+            if previous_result is None:
+                continue
+            limit = previous_result["seconds"] * (1 + tolerance)
+            if result["seconds"] > limit:
+                regressions.append((
+                    run["config"],
+                    stage,
+                    previous_result["seconds"],
+                    result["seconds"]
+                ))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Mesure le temps et la mémoire de chaque étape."
+    )
+    parser.add_argument("--weeks", type=int, nargs='+', default=[16])
+    parser.add_argument("--groups", type=int, nargs='+', default=[18])
+    parser.add_argument("--slots", type=int, nargs='+', default=[10])
+    parser.add_argument("--colleurs", type=int, nargs='+', default=[20])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--memory", type=int, nargs='+')
+    args = parser.parse_args()
+
+    if args.memory:
+        peak_memories = measure_streaming_memory(args.memory)
+        for colleurs, peak_memory in peak_memories.items():
+            print(f"  {colleurs:6d} colleurs {peak_memory:8d} Ko")
+
+        smallest = peak_memories[min(args.memory)]
+        largest = peak_memories[max(args.memory)]
+        if largest > smallest * (1 + args.tolerance):
+            print(f"La mémoire augmente avec l'entrée : {smallest} Ko -> "
+                  f"{largest} Ko")
+            sys.exit(1)
+        return
+
+    results = {
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "runs": [],
+    }
+
+    for weeks, groups, slots, colleurs in itertools.product(
+            args.weeks,
+            args.groups,
+            args.slots,
+            args.colleurs
+    ):
+        config = {
+            "weeks": weeks,
+            "groups": groups,
+            "slots_per_day": slots,
+            "colleurs": colleurs,
+        }
+        print(f"Configuration {config}")
+
+        stages = run_benchmark(weeks, groups, slots, colleurs, args.repeat)
+        for stage, result in stages.items():
+            print(
+                f"  {stage:<24} {result['seconds'] * 1000:9.2f} ms "
+                f"{result['peak_memory_kb']:8d} Ko"
+            )
+
+        results["runs"].append({"config": config, "stages": stages})
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Résultats enregistrés dans {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+
+        regressions = find_regressions(previous, results, args.tolerance)
+        for config, stage, previous_seconds, seconds in regressions:
+            print(
+                f"Régression {config} {stage} : "
+                f"{previous_seconds * 1000:.2f} ms -> {seconds * 1000:.2f} ms"
+            )
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,39 @@
+import argparse
+import bisect
 import csv
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import struct
 import sys
+import threading
 
-import pytz
-from datetime import datetime, timedelta, time
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, time, timezone
 from enum import Enum
-from icalendar import Calendar, Event
+from functools import lru_cache, reduce
+from math import gcd
+from time import monotonic, perf_counter
+from urllib.parse import parse_qs, urlparse
 
-# Define timezone for France (Europe/Paris)
-PARIS_TZ = pytz.timezone('Europe/Paris')
+# pytz, icalendar, http.server, concurrent.futures and email.utils are only
+# imported by the functions needing them, so that short commands start
+# quickly
+
+logger = logging.getLogger("csv_to_ical")
+
+# Timezone of the calendars, provided by "pytz" or by the standard library's
+# "zoneinfo", see `get_timezone`
+TIMEZONE_NAME = 'Europe/Paris'
+TIMEZONE_BACKEND = "pytz"
 
 # Counting saturday
 DAYS_IN_WEEK = 6
@@ -16,6 +42,8 @@ VACATION_STARTING_WEEKS = [
     5,  # Toussaint
     14,  # Noël
 ]
+# Length in weeks of the vacations starting at a given week, 2 if not given
+VACATION_LENGTHS = {}
 WEEK_COUNT = 16
 GROUP_COUNT = 3
 START_DATE = datetime(day=16, month=9, year=2024)
@@ -64,17 +92,55 @@ class ChangingGroup(Enum):
     G3 = 2
 
 
-# The entrypoint of the program
-def main():
-    colle_group = _get_user_colle_group()
+STATIC_GROUPS = [
+    StaticGroup.A,
+    StaticGroup.B,
+    StaticGroup.C
+]
+COLLE_GROUPS = range(1, 19)
+
+# Kinds of events that `iter_events` can include
+EVENT_KINDS = ["colles", "schedule", "room", "lv2", "ds"]
+
+# Hashes of the inputs of every output of the incremental mode
+MANIFEST_FILENAME = ".csv_to_ical_manifest.json"
+# DTSTAMP and SEQUENCE of the generated events, see `EventState`
+EVENT_STATE_FILENAME = ".csv_to_ical_events.json"
+# Settings of a class folder, see `read_class_config`
+CLASS_CONFIG_FILENAME = "config.json"
+# ETag and Last-Modified of the files written by `publish`
+PUBLISH_INDEX_FILENAME = "index.json"
+# Precompressed variants of the published calendars
+PUBLISH_VARIANTS = [".gz", ".br"]
+# Sources compiled by `compile_bundle`, loaded instead of the CSV files
+BUNDLE_FILENAME = ".csv_to_ical.bundle"
+_BUNDLE_MAGIC = b"CSVICALB"
+_BUNDLE_VERSION = 2
+# Struct codes of the columns of the records: start and end seconds, date
+# ordinal (0 if none), indices of the subject, room and colleur in the
+# strings (-1 if none) and group (-1 if none)
+_BUNDLE_COLUMNS = "IIiiiih"
+
+
+# Generates the periods when a colle group is busy, by default during the
+# DS, in schedule_occupied_<group>.ics, see `write_freebusy`
+def generate_occupied(
+        colle_group,
+        include_colles=False,
+        include_schedule=False,
+        include_room_planning=False,
+        include_lv2=False,
+        include_ds=True
+):
     generate_schedule(
             colle_group=colle_group,
             output_filename=f"schedule_occupied_{colle_group}.ics",
-            include_colles=False,
-            include_schedule=False,
-            include_room_planning=False,
-            include_lv2=False,
-            include_ds=True
+            include_colles=include_colles,
+            include_schedule=include_schedule,
+            include_room_planning=include_room_planning,
+            include_lv2=include_lv2,
+            include_ds=include_ds,
+            occupancy=True
     )
 
 
@@ -86,54 +152,42 @@ def generate_schedule(
         include_schedule=False,
         include_room_planning=False,
         include_lv2=False,
-        include_ds=True
+        include_ds=True,
+        recurring=False,
+        start=None,
+        end=None,
+        occupancy=False
 ):
-    lesson_plannings = None
-    colle_schedule = None
-    room_planning = None
-    ds_planning = None
-
-    if include_ds:
-        ds_planning = parse_csv_ds()
-
-    if include_colles:
-        if colle_group is None:
-            raise Exception("Colle groupe needed")
-        colle_schedule = parse_collometre(colle_group)
-
-    if static_group is None:
-        if colle_group is None:
-            raise Exception("Colle groupe or Static group needed")
-        else:
-            static_group = _get_static_group(colle_group)
-
-    if include_schedule:
-        lesson_plannings = parse_csv_schedule()
-
-    if include_room_planning:
-        if static_group is None:
-            if colle_group is None:
-                raise Exception("Colle group or static group needed")
-
-            static_group = _get_static_group(colle_group)
+    if include_colles and colle_group is None:
+        raise Exception("Colle groupe needed")
+
+    sources = stream_sources(
+            colle_group=colle_group if include_colles else None,
+            include_schedule=include_schedule,
+            include_room_planning=include_room_planning,
+            include_ds=include_ds
+    )
 
-        room_planning = parse_room_schedule()
+    event_state = EventState()
 
-    calendar = get_calendar(
-            include_colles,
-            include_schedule,
-            include_room_planning,
-            colle_schedule,
-            lesson_plannings,
-            room_planning,
-            static_group,
+    _write_schedule(
+            sources,
+            event_state,
+            colle_group=colle_group,
+            static_group=static_group,
+            output_filename=output_filename,
+            include_colles=include_colles,
+            include_schedule=include_schedule,
+            include_room_planning=include_room_planning,
             include_lv2=include_lv2,
             include_ds=include_ds,
-            ds_planning=ds_planning,
+            recurring=recurring,
+            start=start,
+            end=end,
+            occupancy=occupancy
     )
 
-    with open(output_filename, 'wb') as f:
-        f.write(calendar.to_ical())
+    event_state.save()
 
 
 def generate_all(
@@ -141,482 +195,3512 @@ def generate_all(
         include_schedule=True,
         include_room_schedule=False
 ):
+    return generate_batch(_get_all_jobs(
+            include_colles,
+            include_schedule,
+            include_room_schedule
+    ))
+
+
+# Jobs of `generate_all`
+def _get_all_jobs(include_colles, include_schedule, include_room_schedule):
+    jobs = []
+
     if include_schedule:
-        static_group_list = [
-            StaticGroup.A,
-            StaticGroup.B,
-            StaticGroup.C
-        ]
-        for groupe_statique in static_group_list:
-            generate_schedule(
-                    static_group=groupe_statique,
-                    output_filename=f"schedule_{groupe_statique.name}.ics",
-                    include_colles=include_colles,
-                    include_schedule=include_schedule,
-                    include_room_planning=include_room_schedule
-            )
+        for groupe_statique in STATIC_GROUPS:
+            jobs.append({
+                "static_group": groupe_statique,
+                "output_filename": f"schedule_{groupe_statique.name}.ics",
+                "include_schedule": include_schedule,
+                "include_room_planning": include_room_schedule,
+            })
 
-    # TODO add include for colles (on va pas faire de fichier unique avec
-    # colles ET le reste je pense)
+    if include_colles:
+        for colle_group in COLLE_GROUPS:
+            jobs.append({
+                "colle_group": colle_group,
+                "output_filename": f"colles_{colle_group}.ics",
+                "include_colles": True,
+                "include_ds": False,
+            })
+
+    return jobs
+
+
+# Generates several calendars while parsing every source only once.
+# Each job is a dict of `generate_schedule` keyword arguments.
+# Returns the time spent parsing and emitting, in seconds.
+def generate_batch(jobs):
+    jobs = [_complete_job(job) for job in jobs]
+
+    parse_start = perf_counter()
+    sources = _parse_jobs_sources(jobs)
+    parse_time = perf_counter() - parse_start
+
+    event_state = EventState()
+    fragments = FragmentCache(event_state)
+
+    emit_start = perf_counter()
+    for job in jobs:
+        _write_schedule(sources, event_state, fragments=fragments, **job)
+    emit_time = perf_counter() - emit_start
+
+    event_state.save()
+
+    print(f"Parsing : {parse_time:.3f}s")
+    print(f"Génération de {len(jobs)} calendrier(s) : {emit_time:.3f}s")
+
+    return {"parse": parse_time, "emit": emit_time}
+
+
+# Same as `generate_batch` but spreads the jobs across `workers` processes
+# (one per core by default). The sources are parsed once and handed to every
+# worker, and a failing job does not stop the others: the failures are
+# reported and returned as (output_filename, exception) pairs.
+def generate_parallel(jobs, workers=None):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    jobs = [_complete_job(job) for job in jobs]
+
+    parse_start = perf_counter()
+    sources = _parse_jobs_sources(jobs)
+    parse_time = perf_counter() - parse_start
+
+    failures = []
+    event_state = EventState()
+
+    emit_start = perf_counter()
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(sources, event_state)
+    ) as executor:
+        futures = {
+            executor.submit(_run_worker_job, job): job for job in jobs
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                event_state.update(future.result())
+            except Exception as e:
+                print(f"Échec de {job['output_filename']} : {e!r}")
+                failures.append((job["output_filename"], e))
+    emit_time = perf_counter() - emit_start
+
+    event_state.save()
+
+    print(f"Parsing : {parse_time:.3f}s")
+    print(
+        f"Génération de {len(jobs) - len(failures)}/{len(jobs)} "
+        f"calendrier(s) : {emit_time:.3f}s"
+    )
 
+    return {"parse": parse_time, "emit": emit_time, "failures": failures}
 
-# Parses the CSV schedules per group and returns a list of plannings per group
-def parse_csv_schedule():
-    plannings = [None] * GROUP_COUNT
 
-    for groupe_changeant_index in range(GROUP_COUNT):
-        planning = [[] for day in range(DAYS_IN_WEEK)]
+# Sources, event state and fragments shared by the jobs of a worker process,
+# set by `_init_worker`
+_worker_sources = None
+_worker_event_state = None
+_worker_fragments = None
 
-        # Open and read the CSV file
-        with open(
-                rf'{groupe_changeant_index}.csv',
-                newline='',
-                encoding='utf-8'
-        ) as csvfile:
-            csvreader = csv.reader(csvfile)
-            # Ignore the headers
-            _ = next(csvreader)
 
-            for row in csvreader:
-                for day in range(0, DAYS_IN_WEEK):
-                    event = (row[0], row[day + 1])  # (hour, event)
-                    planning[day].append(event)
+def _init_worker(sources, event_state):
+    global _worker_sources, _worker_event_state, _worker_fragments
+    _worker_sources = sources
+    _worker_event_state = event_state
+    _worker_fragments = FragmentCache(event_state)
 
-        cleaned_planning = _group_long_subjects(planning)
-        plannings[groupe_changeant_index] = cleaned_planning
 
-    return plannings
+# Returns the event state changes, to be merged by the parent process
+def _run_worker_job(job):
+    _write_schedule(
+            _worker_sources,
+            _worker_event_state,
+            fragments=_worker_fragments,
+            **job
+    )
+    return _worker_event_state.changed
+
+
+# Parses the sources needed by at least one of the jobs
+def _parse_jobs_sources(jobs):
+    return parse_sources(
+            colle_groups=sorted({
+                job["colle_group"] for job in jobs if job["include_colles"]
+            }),
+            include_schedule=any(job["include_schedule"] for job in jobs),
+            include_room_planning=any(
+                job["include_room_planning"] for job in jobs
+            ),
+            include_ds=any(job["include_ds"] for job in jobs)
+    )
 
 
-def parse_csv_ds():
-    with open("ds.csv", newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile)
-        # Extract the header
-        _ = next(reader)
+# Same as `generate_batch` but only regenerates the calendars whose inputs or
+# options changed since the last run, as recorded in `manifest_filename`.
+# Returns the output filenames that were regenerated and skipped.
+def generate_incremental(jobs, manifest_filename=MANIFEST_FILENAME):
+    jobs = [_complete_job(job) for job in jobs]
+    manifest = _read_manifest(manifest_filename)
+    file_hashes = {}
+
+    jobs_to_run = []
+    entries = {}
+    skipped = []
+
+    for job in jobs:
+        output_filename = job["output_filename"]
+        entry = {
+            "inputs": {
+                filename: _hash_file(filename, file_hashes)
+                for filename in _get_job_inputs(job)
+            },
+            "options": _hash_job_options(job),
+        }
+        reason = _get_rebuild_reason(
+                output_filename,
+                manifest.get(output_filename),
+                entry
+        )
 
-        # Function to parse date in the format "DD/MM/YY"
-        def parse_date(date_str):
-            return datetime.strptime(date_str, '%d/%m/%y')
+        if reason is None:
+            print(f"Ignoré {output_filename} : aucune dépendance modifiée")
+            skipped.append(output_filename)
+            continue
 
-        weeks = [[], [], [], []]  # On n'a pas de ds les premieres semaines
+        print(f"Regénération de {output_filename} : {reason}")
+        jobs_to_run.append(job)
+        entries[output_filename] = entry
 
-        # Process each row in the CSV
-        for row in reader:
-            # Handle "Vacances" or "Début S2"
-            if (not row[2]) and (not row[3]) and (not row[4]):
-                continue
+    if jobs_to_run:
+        generate_batch(jobs_to_run)
 
-            # Calculate days for Monday
-            monday_date = parse_date(row[1])
+        manifest.update(entries)
+        with _atomic_open(manifest_filename) as f:
+            f.write(json.dumps(manifest, indent=2, sort_keys=True).encode())
 
-            week_data = []
+    return {
+        "rebuilt": [job["output_filename"] for job in jobs_to_run],
+        "skipped": skipped,
+    }
 
-            # Controle Lundi
-            if row[2]:
-                start_datetime = PARIS_TZ.localize(
-                    datetime.combine(monday_date, time(16, 20)))
-                end_datetime = PARIS_TZ.localize(
-                    datetime.combine(monday_date, time(18, 15)))
 
-                event = {"subject": row[2], "start_time": start_datetime, "end_time": end_datetime}
-                week_data.append(event)
-            # Controle Mercredi
-            if row[3]:
-                start_datetime = PARIS_TZ.localize(
-                    datetime.combine(monday_date + timedelta(days=2), time(15, 15)))
-                end_datetime = PARIS_TZ.localize(
-                    datetime.combine(monday_date + timedelta(days=2), time(18, 15)))
+# Files a job depends on. The script itself is included since the settings
+# (dates, vacations, times...) live in it.
+def _get_job_inputs(job):
+    return [os.path.abspath(__file__)] + _get_job_sources(job)
 
-                event = {"subject": row[3], "start_time": start_datetime, "end_time": end_datetime}
-                week_data.append(event)
-            # Controle lundi
-            if row[4]:
-                start_datetime = PARIS_TZ.localize(
-                    datetime.combine(monday_date + timedelta(days=5), time(8, 0)))
-                end_datetime = PARIS_TZ.localize(
-                    datetime.combine(monday_date + timedelta(days=5), time(12, 15)))
 
-                event = {"subject": row[4], "start_time": start_datetime, "end_time": end_datetime}
-                week_data.append(event)
+# CSV files a job depends on
+def _get_job_sources(job):
+    inputs = []
 
-            weeks.append(week_data)
-    return weeks
+    if job["include_schedule"]:
+        inputs += [
+            f"{groupe_changeant_index}.csv"
+            for groupe_changeant_index in range(GROUP_COUNT)
+        ]
 
+    if job["include_room_planning"]:
+        inputs.append("room.csv")
 
-def parse_room_schedule():
-    planning = [[] for day in range(DAYS_IN_WEEK)]
+    if job["include_ds"]:
+        inputs.append("ds.csv")
 
-    with open("room.csv", newline='', encoding="utf-8") as csvfile:
-        reader = csv.reader(csvfile)
+    if job["include_colles"]:
+        inputs.append("collometre.csv")
 
-        _ = next(reader)
+    return inputs
 
-        for row in reader:
-            for day in range(DAYS_IN_WEEK):
 
-                event = ("", 0)
-                if row[day+1] not in ["1", "2", "3"]:
-                    event = (row[0], None)
-                else:
-                    event = (row[0], int(row[day + 1]) - 1)
-                print(event)
-                planning[day].append(event)
+def _hash_file(filename, file_hashes):
+    if filename not in file_hashes:
+        with open(filename, 'rb') as f:
+            file_hashes[filename] = hashlib.sha256(f.read()).hexdigest()
 
-    return _group_long_subjects(planning)
+    return file_hashes[filename]
 
 
-def parse_collometre(colle_group):
-    colles = []
+def _hash_job_options(job):
+    options = {
+        key: _get_json_option(value)
+        for key, value in job.items()
+        if key != "output_filename"
+    }
+    return hashlib.sha256(
+            json.dumps(options, sort_keys=True).encode()
+    ).hexdigest()
 
-    with open("collometre.csv", newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile)
 
-        _ = next(reader)
-        current_subject = ""
+def _get_json_option(value):
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
 
-        for row in reader:
-            # If the second colum is empty, it's a subject row
-            if not row[1]:
-                current_subject = row[0].strip()
+
+# Returns why an output must be regenerated, or None if it is up to date
+def _get_rebuild_reason(output_filename, previous_entry, entry):
+    if not os.path.exists(output_filename):
+        return "fichier absent"
+
+    if previous_entry is None:
+        return "absent du manifeste"
+
+    if previous_entry["options"] != entry["options"]:
+        return "options modifiées"
+
+    changed_inputs = [
+        os.path.basename(filename)
+        for filename, file_hash in entry["inputs"].items()
+        if previous_entry["inputs"].get(filename) != file_hash
+    ]
+    if changed_inputs:
+        return ", ".join(changed_inputs) + " modifié(s)"
+
+    return None
+
+
+def _read_manifest(manifest_filename):
+    try:
+        with open(manifest_filename, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# Generates the calendars of `jobs`, then watches their CSV files every
+# `interval` seconds until `stop` (a `threading.Event`) is set. When a file
+# changes, only that file is parsed again and only the calendars depending
+# on it are regenerated, once the file has not changed for `debounce`
+# seconds so that successive saves are handled once.
+def watch(jobs, interval=0.5, debounce=1.0, stop=None):
+    jobs = [_complete_job(job) for job in jobs]
+    stop = stop or threading.Event()
+
+    # CSV file -> jobs depending on it
+    dependencies = {}
+    for job in jobs:
+        for filename in _get_job_sources(job):
+            dependencies.setdefault(filename, []).append(job)
+
+    signatures = {
+        filename: _get_file_signature(filename) for filename in dependencies
+    }
+    sources = _parse_jobs_sources(jobs)
+    event_state = EventState()
+
+    fragments = FragmentCache(event_state)
+    for job in jobs:
+        _write_schedule(sources, event_state, fragments=fragments, **job)
+    event_state.save()
+    print(f"{len(jobs)} calendrier(s) générés, surveillance de "
+          f"{len(dependencies)} fichier(s)")
+
+    # File -> time of its last change not handled yet
+    pending = {}
+
+    while not stop.wait(interval):
+        now = monotonic()
+
+        for filename, signature in signatures.items():
+            current_signature = _get_file_signature(filename)
+            if current_signature != signature:
+                signatures[filename] = current_signature
+                pending[filename] = now
+
+        changed_filenames = [
+            filename for filename, changed_at in pending.items()
+            if now - changed_at >= debounce
+        ]
+        if not changed_filenames:
+            continue
+
+        jobs_to_run = []
+        for filename in changed_filenames:
+            del pending[filename]
+
+            try:
+                _parse_source_file(sources, filename)
+            except Exception as e:
+                # e.g. a file being written, parsed again at its next change
+                print(f"Erreur en lisant {filename} : {e}")
                 continue
 
-            colleur = row[0].strip()
-            colle_time = row[1].strip()
-            room = row[2].strip()
+            print(f"{filename} modifié")
+            jobs_to_run += [
+                job for job in dependencies[filename]
+                if job not in jobs_to_run
+            ]
+
+        # The sources changed, so do the shared components
+        fragments = FragmentCache(event_state)
+        for job in jobs_to_run:
+            try:
+                _write_schedule(
+                        sources,
+                        event_state,
+                        fragments=fragments,
+                        **job
+                )
+            except Exception as e:
+                print(f"Échec de {job['output_filename']} : {e}")
+                continue
+            print(f"Regénération de {job['output_filename']}")
+        event_state.save()
 
-            day_abbr, time_range = colle_time.split(' ')
 
-            # Determine if the time range uses 'h' format or not and parse
-            # accordingly
-            if 'h' in time_range:
-                start_time_str, end_time_str = time_range.split('-')
-                # e.g. 12h15
-                start_time = datetime.strptime(start_time_str, '%Hh%M').time()
-                end_time = datetime.strptime(end_time_str, '%Hh%M').time()
+# Modification time and size of a file, None if it does not exist
+def _get_file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+# Parses `filename` again and replaces its part of `sources`
+def _parse_source_file(sources, filename):
+    if filename == "room.csv":
+        sources.room_planning = parse_room_schedule()
+    elif filename == "ds.csv":
+        sources.ds_planning = parse_csv_ds()
+    elif filename == "collometre.csv":
+        collometre_index = build_collometre_index()
+        sources.colle_plannings = {
+            colle_group: collometre_index.get(colle_group, [])
+            for colle_group in sources.colle_plannings
+        }
+    else:
+        # "<changing group>.csv", the other groups are kept as they are
+        groupe_changeant_index = int(os.path.splitext(filename)[0])
+        lesson_plannings = list(sources.lesson_plannings)
+        lesson_plannings[groupe_changeant_index] = \
+            _parse_group_schedule(groupe_changeant_index)
+        sources.lesson_plannings = lesson_plannings
+
+
+# Writes the calendars of `jobs` in `directory` for a static file server,
+# with their compressed variants (see `_get_compressors`) compressed by
+# `workers` threads. A calendar whose content did not change is left
+# untouched, mtime included, so that conditional requests keep getting 304
+# responses. The ETag and Last-Modified of every published file are listed
+# in `index_filename`.
+def publish(
+        jobs,
+        directory=".",
+        workers=None,
+        index_filename=PUBLISH_INDEX_FILENAME
+):
+    from concurrent.futures import ThreadPoolExecutor
+
+    jobs = [_complete_job(job) for job in jobs]
+    os.makedirs(directory, exist_ok=True)
+    index_path = os.path.join(directory, index_filename)
+    previous_index = _read_manifest(index_path)
+    compressors = _get_compressors()
+
+    sources = _parse_jobs_sources(jobs)
+    event_state = EventState()
+    fragments = FragmentCache(event_state)
+
+    index = {}
+    written = []
+    unchanged = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Published filename -> future of its index entry
+        futures = {}
+
+        for job in jobs:
+            job = dict(job)
+            output_filename = job.pop("output_filename")
+            f = io.BytesIO()
+            _write_schedule_calendar(
+                    f,
+                    sources,
+                    event_state,
+                    output_filename,
+                    fragments,
+                    **job
+            )
+            body = f.getvalue()
+
+            path = os.path.join(directory, output_filename)
+            changed = _read_published_file(path) != body
+            if changed:
+                futures[output_filename] = executor.submit(
+                        _write_published_file,
+                        path,
+                        body
+                )
+                written.append(output_filename)
             else:
-                start_time_str, end_time_str = time_range.split('-')
-                # e.g. 12
-                start_time = datetime.strptime(start_time_str, '%H').time()
-                end_time = datetime.strptime(end_time_str, '%H').time()
+                index[output_filename] = _get_index_entry(
+                        path,
+                        previous_index.get(output_filename)
+                )
+                unchanged.append(output_filename)
 
-            # Iterate over the groups (skipping columns 0, 1, and 2)
-            for i, group in enumerate(row[3:], 3):
-                # Handle multiple groups separated by '+'
-                groups = group.split('+') if group else []
-
-                # Check if one of the groups if the targeted colle group
-                for g in groups:
-                    g_int = int(g)
-                    if colle_group == g_int:
-                        break
-                # If the targeted colle group is not in groups, continue the
-                # bigger loop
-                else:
-                    continue
+            for suffix in PUBLISH_VARIANTS:
+                variant = output_filename + suffix
+                variant_path = path + suffix
 
-                current_week = _apply_week_offsets(i - 3)
+                if suffix not in compressors:
+                    # Would be served instead of the new calendar
+                    if changed and os.path.exists(variant_path):
+                        os.remove(variant_path)
+                    continue
 
-                # Calculate the actual event date based on the day abbreviation
-                if day_abbr in DAY_ABBR_MAP:
-                    day_offset = DAY_ABBR_MAP[day_abbr]
-                    event_date = START_DATE + timedelta(
-                            days=day_offset,
-                            weeks=current_week
+                if changed or not os.path.exists(variant_path):
+                    futures[variant] = executor.submit(
+                            _write_published_file,
+                            variant_path,
+                            body,
+                            compressors[suffix]
                     )
                 else:
-                    continue  # Skip unknown day abbreviations
-
-                colles.append((
-                    current_subject,
-                    colleur,
-                    (event_date, start_time, end_time),
-                    room
-                ))
+                    index[variant] = _get_index_entry(
+                            variant_path,
+                            previous_index.get(variant)
+                    )
 
-    return colles
+        for filename, future in futures.items():
+            index[filename] = future.result()
 
+    event_state.save()
 
-def get_calendar(
-        include_colles=True,
-        include_schedule=True,
-        include_room_schedule=False,
-        colle_planning=None,
-        lesson_plannings=None,
-        room_planning=None,
-        static_group=None,
-        include_lv2=False,
-        include_ds=False,
-        ds_planning=None
-):
-    if static_group is None:
-        raise Exception("Il faut un groupe statique")
+    if index != previous_index:
+        with _atomic_open(index_path) as f:
+            f.write(json.dumps(index, indent=2, sort_keys=True).encode())
 
-    if lesson_plannings is None and include_schedule:
-        raise Exception("Il faut un planning")
+    print(f"{len(written)} calendrier(s) publiés, {len(unchanged)} inchangés")
 
-    if colle_planning is None and include_colles:
-        raise Exception("Il faut un planning de colles")
+    return {"written": written, "unchanged": unchanged}
 
-    if room_planning is None and include_room_schedule:
-        raise Exception("Il faut le planning de la salle")
 
-    calendar = Calendar()
+# Compression functions of the published variants by suffix. Brotli is
+# optional, its variants are only written if the brotli package is installed.
+def _get_compressors():
+    # Without the time in the gzip header, the same calendar always gives
+    # the same file
+    compressors = {".gz": lambda data: gzip.compress(data, mtime=0)}
 
-    current_week = 0
-    # To take vacation into account
-    week_offset = 0
+    try:
+        import brotli
+    except ImportError:
+        logger.warning("brotli n'est pas installé, pas de fichiers .br")
+    else:
+        compressors[".br"] = brotli.compress
 
-    if include_schedule or include_room_schedule:
-        while current_week < WEEK_COUNT:
-            if include_schedule:
-                lesson_events = _get_week_events(
-                        lesson_plannings[
-                            # We do not add `week_offset` because vacation
-                            # don't count in the changing group pattern
-                            _get_changing_group(static_group, current_week)
-                        ],
-                        current_week + week_offset
-                )
+    return compressors
 
-                for event in lesson_events:
-                    calendar.add_component(event)
 
-            if include_room_schedule:
-                room_events = _get_week_room_events(
-                        room_planning,
-                        _get_changing_group(static_group, current_week),
-                        current_week + week_offset
-                )
+# Content of a published file, None if it does not exist
+def _read_published_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
 
-                for event in room_events:
-                    calendar.add_component(event)
 
-            week_offset += _get_next_week_offset(current_week + week_offset)
-            current_week += 1
+# Writes a published file, compressed by `compress` if given, and returns
+# its index entry
+def _write_published_file(path, body, compress=None):
+    if compress is not None:
+        body = compress(body)
 
-    if include_colles:
-        colle_events = _get_colle_events(colle_planning)
-        for event in colle_events:
-            calendar.add_component(event)
+    with _atomic_open(path) as f:
+        f.write(body)
 
-    if include_lv2:
-        lv2_events = _get_lv2_events()
-        for event in lv2_events:
-            calendar.add_component(event)
+    return _get_index_entry(path, content=body)
 
-    if include_ds:
-        ds_events = _get_DS_events(ds_planning)
-        for event in ds_events:
-            calendar.add_component(event)
 
-    return calendar
+# ETag and Last-Modified of a published file. The ETag of the previous
+# entry is kept as long as the file keeps the mtime it was computed for.
+def _get_index_entry(path, previous_entry=None, content=None):
+    from email.utils import formatdate
 
+    stat = os.stat(path)
 
-def _get_lv2_events():
-    current_week = 0
-    # To take vacation into account
-    week_offset = 0
+    if previous_entry is not None and content is None \
+            and previous_entry["mtime_ns"] == stat.st_mtime_ns \
+            and previous_entry["size"] == stat.st_size:
+        return previous_entry
 
-    events = []
+    if content is None:
+        content = _read_published_file(path)
 
-    while current_week < WEEK_COUNT:
-        event_date = START_DATE + timedelta(days=LV2_HORAIRE["day_index"], weeks=current_week+week_offset)
+    return {
+        "etag": f'"{hashlib.sha1(content).hexdigest()}"',
+        "last_modified": formatdate(stat.st_mtime, usegmt=True),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+    }
 
-        # Combine date with time
-        start_datetime = PARIS_TZ.localize(
-            datetime.combine(event_date, LV2_HORAIRE["start_time"]))
-        end_datetime = PARIS_TZ.localize(
-            datetime.combine(event_date, LV2_HORAIRE["end_time"]))
 
-        event = Event()
-        event.add('summary', "LV2")
-        event.add('dtstart', start_datetime)
-        event.add('dtend', end_datetime)
-        event.add('dtstamp', datetime.now())
+# Generates the calendars of several classes in one run. Every folder of
+# `directory` with a config.json file (see `read_class_config`) is a class,
+# with its own CSV files, event state and manifest. The calendars are
+# written in the class folder, or in `output_directory`/<class> if given.
+# The classes are spread across `workers` processes (one per core by
+# default), a failing class does not stop the others. Returns the failures
+# as (class, exception) pairs.
+def generate_classes(directory, output_directory=None, workers=None):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    class_directories = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.isfile(
+            os.path.join(directory, name, CLASS_CONFIG_FILENAME)
+        )
+    )
+    if not class_directories:
+        raise Exception(f"Aucune classe trouvée dans {directory}")
+
+    failures = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for class_directory in class_directories:
+            try:
+                config = read_class_config(class_directory)
+            except Exception as e:
+                print(f"Échec de {class_directory} : {e!r}")
+                failures.append((class_directory, e))
+                continue
 
-        events.append(event)
+            class_output_directory = None
+            if output_directory is not None:
+                class_output_directory = os.path.join(
+                        os.path.abspath(output_directory),
+                        os.path.basename(class_directory)
+                )
 
-        week_offset += _get_next_week_offset(current_week + week_offset)
-        current_week += 1
+            futures[executor.submit(
+                    _generate_class,
+                    os.path.abspath(class_directory),
+                    config,
+                    class_output_directory
+            )] = class_directory
+
+        for future in as_completed(futures):
+            class_directory = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Échec de {class_directory} : {e!r}")
+                failures.append((class_directory, e))
+
+    print(
+        f"{len(class_directories) - len(failures)}/{len(class_directories)} "
+        f"classe(s) générée(s)"
+    )
 
-    return events
+    return failures
 
-def _get_DS_events(ds_planning):
-    events = []
-    for week in ds_planning:
-        for week_event in week:
-            event = Event()
-            event.add('summary', f"[DS] {week_event['subject']}")
-            event.add('dtstart', week_event["start_time"])
-            event.add('dtend', week_event["end_time"])
-            event.add('dtstamp', datetime.now())
-
-            events.append(event)
-    return events
 
-def _get_user_colle_group():
-    if len(sys.argv) >= 2:
-        arg = sys.argv[1]
-        try:
-            group = int(arg)
-            if 1 <= group <= 18:
-                return group
-        except ValueError:
-            pass
+# Generates the calendars of a class with its settings, in a worker process
+# since the working directory and the settings are global
+def _generate_class(class_directory, config, output_directory):
+    settings, calendars = config
+    previous_directory = os.getcwd()
+    os.chdir(class_directory)
 
-    user_input = input("Entrez le numéro de votre groupe de colle : ")
     try:
-        group = int(user_input)
-    except ValueError:
-        print("Veuillez entrer un nombre entier entre 1 et 18.")
-        exit(1)
+        with class_settings(settings):
+            jobs = _get_all_jobs(
+                    calendars["colles"],
+                    calendars["schedule"],
+                    calendars["room"]
+            )
 
-    if 1 <= group <= 18:
-        return group
+            if output_directory is not None:
+                os.makedirs(output_directory, exist_ok=True)
+                for job in jobs:
+                    job["output_filename"] = os.path.join(
+                            output_directory,
+                            job["output_filename"]
+                    )
 
-    print("Le numéro groupe doit être compris entre 1 et 18 inclus.")
-    exit(1)
+            print(f"Classe {os.path.basename(class_directory)}")
+            return generate_batch(jobs)
+    finally:
+        os.chdir(previous_directory)
 
 
-def _get_static_group(colle_group):
-    static_group_list = [
-        StaticGroup.A,
-        StaticGroup.B,
-        StaticGroup.C
-    ]
-    return static_group_list[(colle_group + 2) % 3]
+# Sets the module settings, e.g. as read by `read_class_config`, until the
+# end of the block
+@contextmanager
+def class_settings(settings):
+    module_settings = globals()
+    previous_settings = {name: module_settings[name] for name in settings}
+    module_settings.update(settings)
 
+    try:
+        yield
+    finally:
+        module_settings.update(previous_settings)
+
+
+# Keys of a class config.json: key -> (module setting, parse of the value)
+_CLASS_SETTINGS = {
+    "start_date": ("START_DATE", datetime.fromisoformat),
+    "week_count": ("WEEK_COUNT", int),
+    "vacation_starting_weeks": (
+        "VACATION_STARTING_WEEKS",
+        lambda weeks: [int(week) for week in weeks]
+    ),
+    "vacation_lengths": (
+        "VACATION_LENGTHS",
+        lambda lengths: {
+            int(week): int(length) for week, length in lengths.items()
+        }
+    ),
+    "colle_group_count": (
+        "COLLE_GROUPS",
+        lambda count: range(1, int(count) + 1)
+    ),
+    "day_abbr_map": (
+        "DAY_ABBR_MAP",
+        lambda days: {abbr: int(day) for abbr, day in days.items()}
+    ),
+    "end_time_map": (
+        "END_TIME_MAP",
+        lambda times: {
+            key: time.fromisoformat(value) for key, value in times.items()
+        }
+    ),
+    "lv2": (
+        "LV2_HORAIRE",
+        lambda lv2: {
+            "day_index": int(lv2["day_index"]),
+            "start_time": time.fromisoformat(lv2["start_time"]),
+            "end_time": time.fromisoformat(lv2["end_time"]),
+        }
+    ),
+    "timezone": ("TIMEZONE_NAME", str),
+}
 
-def _apply_week_offsets(current):
-    current_with_offsets = current
+# Calendars generated for a class by default, see `_get_all_jobs`
+_CLASS_CALENDARS = {"colles": True, "schedule": True, "room": False}
+
+# Filename -> (modification time and size, parsed config)
+_class_configs = {}
+
+
+# Returns the settings of a class folder, read from its config.json, as
+# (module settings, calendars). The settings not given keep their value.
+# e.g.
+# {
+#     "start_date": "2025-09-01",
+#     "week_count": 30,
+#     "vacation_starting_weeks": [7, 16],
+#     "vacation_lengths": {"16": 1},
+#     "colle_group_count": 15,
+#     "end_time_map": {"08:30": "08:30", ..., "last_hour": "18:15"},
+#     "lv2": {"day_index": 3, "start_time": "16:20", "end_time": "18:15"},
+#     "calendars": {"colles": true, "schedule": true, "room": false}
+# }
+# The configs are parsed again only when their file changes.
+def read_class_config(class_directory):
+    filename = os.path.join(class_directory, CLASS_CONFIG_FILENAME)
+    signature = _get_file_signature(filename)
+
+    cached = _class_configs.get(filename)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with open(filename, encoding='utf-8') as f:
+        values = json.load(f)
+
+    settings = {}
+    calendars = dict(_CLASS_CALENDARS)
+
+    for key, value in values.items():
+        if key == "calendars":
+            unknown_calendars = set(value) - set(_CLASS_CALENDARS)
+            if unknown_calendars:
+                raise Exception(
+                        f"Calendriers inconnus dans {filename} : "
+                        + ", ".join(sorted(unknown_calendars))
+                )
+            calendars.update(
+                    {name: bool(include) for name, include in value.items()}
+            )
+            continue
 
-    for starting_vacation_week in sorted(VACATION_STARTING_WEEKS):
-        if current_with_offsets >= starting_vacation_week:
-            current_with_offsets += 2
+        if key not in _CLASS_SETTINGS:
+            raise Exception(f"Paramètre inconnu dans {filename} : {key}")
 
-    return current_with_offsets
+        name, parse = _CLASS_SETTINGS[key]
+        try:
+            settings[name] = parse(value)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise Exception(f"Valeur invalide de {key} dans {filename} : {e}")
+
+    config = (settings, calendars)
+    _class_configs[filename] = (signature, config)
+    return config
+
+
+# Every source parsed once, shared by all the calendars of a batch
+class ScheduleSources:
+    def __init__(
+            self,
+            lesson_plannings=None,
+            room_planning=None,
+            ds_planning=None,
+            colle_plannings=None
+    ):
+        self.lesson_plannings = lesson_plannings
+        self.room_planning = room_planning
+        self.ds_planning = ds_planning
+        # Colle group -> colles of that group
+        self.colle_plannings = colle_plannings or {}
+
+
+# Same as `parse_sources` for a single calendar, the DS and colles being
+# read while the calendar is written instead of being parsed beforehand
+def stream_sources(
+        colle_group=None,
+        include_schedule=True,
+        include_room_planning=True,
+        include_ds=True
+):
+    sources = load_bundle(
+            colle_groups=() if colle_group is None else [colle_group],
+            include_schedule=include_schedule,
+            include_room_planning=include_room_planning,
+            include_ds=include_ds
+    )
+    if sources is not None:
+        return sources
 
+    sources = parse_sources(
+            include_schedule=include_schedule,
+            include_room_planning=include_room_planning,
+            include_ds=False
+    )
 
-# Gives the actual changing group given the current week
-def _get_changing_group(static_group, current_week):
-    static_to_changin_group_map = {
-        StaticGroup.A: ChangingGroup.G1,
-        StaticGroup.B: ChangingGroup.G2,
-        StaticGroup.C: ChangingGroup.G3,
-    }
-    return (static_to_changin_group_map[static_group].value - current_week) % 3
+    if include_ds:
+        sources.ds_planning = iter_ds_weeks()
 
+    if colle_group is not None:
+        sources.colle_plannings[colle_group] = iter_colles(colle_group)
 
-# Returns a list of all current week events
-def _get_week_events(planning, current_week):
-    events = []
+    return sources
 
-    for day_index, day_schedule in enumerate(planning):
-        event_date = START_DATE + timedelta(days=day_index, weeks=current_week)
 
-        day_events = _get_day_lessons_events(event_date, day_schedule)
+# Parses the sources from the CSV files, or loads them from the bundle if it
+# was compiled from the current ones, see `compile_bundle`
+def parse_sources(
+        colle_groups=(),
+        include_schedule=True,
+        include_room_planning=True,
+        include_ds=True
+):
+    sources = load_bundle(
+            colle_groups=colle_groups,
+            include_schedule=include_schedule,
+            include_room_planning=include_room_planning,
+            include_ds=include_ds
+    )
+    if sources is not None:
+        return sources
 
-        events += day_events
+    sources = ScheduleSources()
 
-    return events
+    if include_schedule:
+        sources.lesson_plannings = parse_csv_schedule()
 
+    if include_room_planning:
+        sources.room_planning = parse_room_schedule()
 
-def _get_week_room_events(room_planning, changing_group, current_week):
-    events = []
+    if include_ds:
+        sources.ds_planning = parse_csv_ds()
+
+    if colle_groups:
+        collometre_index = build_collometre_index()
+        for colle_group in colle_groups:
+            sources.colle_plannings[colle_group] = collometre_index.get(
+                    colle_group,
+                    []
+            )
 
-    for day_index, day_schedule in enumerate(room_planning):
-        event_date = START_DATE + timedelta(days=day_index, weeks=current_week)
+    return sources
 
-        for start_time, end_time, group in day_schedule:
-            if group is None or group == changing_group:
-                continue
 
-            start_datetime = PARIS_TZ.localize(
-                    datetime.combine(event_date, start_time))
-            end_datetime = PARIS_TZ.localize(
-                    datetime.combine(event_date, end_time))
+# Seconds since midnight of a slot time
+def _get_seconds(slot_time):
+    return slot_time.hour * 3600 + slot_time.minute * 60 + slot_time.second
 
-            event = Event()
-            print(group)
-            event.add(
-                    'summary',
-                    "Salle occuppée par G" + str(group+1)
-            )
-            event.add('dtstart', start_datetime)
-            event.add('dtend', end_datetime)
 
-            events.append(event)
+# Writes the sources parsed from every CSV file in a binary bundle, loaded
+# instead of the CSV files by `parse_sources` as long as they don't change.
+#
+# The bundle starts with _BUNDLE_MAGIC, the version and the length of a JSON
+# header giving the hashes of the inputs and the offsets of the sections.
+# The sections are little-endian: the strings, then lists of records
+# (lessons, room, DS), then the colles and the colles of every group. Records
+# are written column by column, so that a whole column is read at once.
+def compile_bundle(filename=BUNDLE_FILENAME):
+    file_hashes = {}
+    inputs = {
+        os.path.basename(input_filename): _hash_file(input_filename, file_hashes)
+        for input_filename in _get_bundle_inputs()
+    }
 
-    return events
+    collometre_index = build_collometre_index()
+    lesson_plannings = parse_csv_schedule()
+    room_planning = parse_room_schedule()
+    ds_planning = parse_csv_ds()
 
+    # Records shared by several groups are written once
+    colles = []
+    colle_indices = {}
+    for colle_group_colles in collometre_index.values():
+        for colle in colle_group_colles:
+            if id(colle) not in colle_indices:
+                colle_indices[id(colle)] = len(colles)
+                colles.append(colle)
+
+    strings = []
+    string_indices = {}
+
+    def get_string_index(value):
+        if value is None:
+            return -1
+        if value not in string_indices:
+            string_indices[value] = len(strings)
+            strings.append(value)
+        return string_indices[value]
+
+    def pack_records(records):
+        columns = list(zip(*[
+            (
+                _get_seconds(record.start_time),
+                _get_seconds(record.end_time),
+                record.date.toordinal() if record.date else 0,
+                get_string_index(record.subject),
+                get_string_index(record.room),
+                get_string_index(record.colleur),
+                -1 if record.group is None else record.group
+            )
+            for record in records
+        ])) or [()] * len(_BUNDLE_COLUMNS)
+        return b"".join(
+            struct.pack(f"<{len(column)}{code}", *column)
+            for code, column in zip(_BUNDLE_COLUMNS, columns)
+        )
 
-# Returns colle events from a colle schedule
-def _get_colle_events(colle_schedule):
-    events = []
+    def pack_record_lists(record_lists):
+        return struct.pack("<I", len(record_lists)) + b"".join(
+            struct.pack("<I", len(records)) + pack_records(records)
+            for records in record_lists
+        )
 
-    for colle in colle_schedule:
-        # Unpack `colle` object
-        subject, colleur, start_end_time, room = colle
-        event_date, start_time, end_time = start_end_time
+    sections = {
+        "lessons": pack_record_lists([
+            day_schedule
+            for planning in lesson_plannings
+            for day_schedule in planning
+        ]),
+        "room": pack_record_lists(room_planning),
+        "ds": pack_record_lists(ds_planning),
+        "colles": struct.pack("<I", len(colles)) + pack_records(colles),
+        "colle_groups": struct.pack("<I", len(collometre_index)) + b"".join(
+            struct.pack("<iI", colle_group, len(colle_group_colles))
+            + struct.pack(
+                f"<{len(colle_group_colles)}I",
+                *[colle_indices[id(colle)] for colle in colle_group_colles]
+            )
+            for colle_group, colle_group_colles in collometre_index.items()
+        ),
+    }
+    # Written last, once all the strings are known
+    encoded_strings = [string.encode('utf-8') for string in strings]
+    sections["strings"] = struct.pack("<I", len(strings)) + b"".join(
+        struct.pack("<I", len(string)) + string for string in encoded_strings
+    )
 
-        # Combine date with time
-        start_datetime = PARIS_TZ.localize(
-                datetime.combine(event_date, start_time))
-        end_datetime = PARIS_TZ.localize(
-                datetime.combine(event_date, end_time))
+    body = io.BytesIO()
+    offsets = {}
+    for name, section in sections.items():
+        offsets[name] = body.tell()
+        body.write(section)
+
+    header = json.dumps({
+        "inputs": inputs,
+        "settings": _get_bundle_settings(),
+        "days_in_week": DAYS_IN_WEEK,
+        "sections": offsets,
+    }, sort_keys=True).encode('utf-8')
+
+    with _atomic_open(filename) as f:
+        f.write(_BUNDLE_MAGIC)
+        f.write(struct.pack("<II", _BUNDLE_VERSION, len(header)))
+        f.write(header)
+        f.write(body.getvalue())
+
+
+# Same as `parse_sources` but reads the sources from a bundle written by
+# `compile_bundle`, `colle_groups=None` meaning every group. Returns None if
+# there is no bundle or if it is stale. `file_hashes` caches the hashes of
+# the inputs.
+def load_bundle(
+        filename=BUNDLE_FILENAME,
+        colle_groups=(),
+        include_schedule=True,
+        include_room_planning=True,
+        include_ds=True,
+        file_hashes=None
+):
+    file_hashes = {} if file_hashes is None else file_hashes
 
-        event = Event()
-        event.add('summary', "[Colle] " + subject)
-        event.add('dtstart', start_datetime)
-        event.add('dtend', end_datetime)
-        event.add('dtstamp', datetime.now())
+    try:
+        f = open(filename, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with f:
+        header_start = len(_BUNDLE_MAGIC) + 8
+        if os.fstat(f.fileno()).st_size < header_start:
+            logger.info("%s n'est pas un bundle", filename)
+            return None
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(_BUNDLE_MAGIC)] != _BUNDLE_MAGIC:
+                logger.info("%s n'est pas un bundle", filename)
+                return None
+
+            version, header_length = struct.unpack_from(
+                    "<II",
+                    mapped,
+                    len(_BUNDLE_MAGIC)
+            )
+            if version != _BUNDLE_VERSION:
+                logger.info("Version %d du bundle ignorée", version)
+                return None
 
-        description = f"Colleur: {colleur}"
-        event.add('description', description)
+            header = json.loads(
+                    mapped[header_start:header_start + header_length]
+            )
+            if header["settings"] != _get_bundle_settings():
+                logger.info("Bundle périmé : paramètres modifiés")
+                return None
+
+            for input_filename in _get_bundle_inputs():
+                try:
+                    input_hash = _hash_file(input_filename, file_hashes)
+                except FileNotFoundError:
+                    input_hash = None
+                if header["inputs"].get(os.path.basename(input_filename)) \
+                        != input_hash:
+                    logger.info("Bundle périmé : %s modifié", input_filename)
+                    return None
+
+            with _profile_stage("parse", filename):
+                reader = _BundleReader(
+                        mapped,
+                        header_start + header_length,
+                        header["sections"]
+                )
+                try:
+                    return reader.read_sources(
+                            colle_groups,
+                            include_schedule,
+                            include_room_planning,
+                            include_ds,
+                            header["days_in_week"]
+                    )
+                finally:
+                    reader.release()
+
+
+# Files the bundle is compiled from, see `_get_job_inputs`
+def _get_bundle_inputs():
+    return _get_job_inputs({
+        "include_schedule": True,
+        "include_room_planning": True,
+        "include_ds": True,
+        "include_colles": True,
+    })
+
+
+# Settings the parsed sources depend on, in their JSON form
+def _get_bundle_settings():
+    return json.loads(json.dumps([
+        START_DATE.isoformat(),
+        WEEK_COUNT,
+        VACATION_STARTING_WEEKS,
+        sorted(VACATION_LENGTHS.items()),
+        GROUP_COUNT,
+        DAYS_IN_WEEK,
+        DAY_ABBR_MAP,
+        {key: value.isoformat() for key, value in END_TIME_MAP.items()},
+    ]))
+
+
+# Reads the sections of a memory-mapped bundle, see `compile_bundle`
+class _BundleReader:
+    def __init__(self, mapped, body_start, offsets):
+        self.view = memoryview(mapped)[body_start:]
+        self.offsets = offsets
+        # Seconds since midnight -> time, ordinal -> date
+        self._times = {}
+        self._dates = {0: None}
+
+        offset = offsets["strings"]
+        count, = struct.unpack_from("<I", self.view, offset)
+        offset += 4
+        self.strings = []
+        for _ in range(count):
+            length, = struct.unpack_from("<I", self.view, offset)
+            offset += 4
+            self.strings.append(
+                    str(self.view[offset:offset + length], 'utf-8')
+            )
+            offset += length
+        # So that the index -1 of a missing string gives None
+        self.strings.append(None)
 
-        if room != "":
-            event.add('location', room)
+    def release(self):
+        self.view.release()
 
-        events.append(event)
+    def read_sources(
+            self,
+            colle_groups,
+            include_schedule,
+            include_room_planning,
+            include_ds,
+            days_in_week
+    ):
+        sources = ScheduleSources()
+
+        if include_schedule:
+            lessons = self._read_record_lists("lessons")
+            sources.lesson_plannings = [
+                lessons[index:index + days_in_week]
+                for index in range(0, len(lessons), days_in_week)
+            ]
+
+        if include_room_planning:
+            sources.room_planning = self._read_record_lists("room")
+
+        if include_ds:
+            sources.ds_planning = self._read_record_lists("ds")
+
+        if colle_groups is None or colle_groups:
+            sources.colle_plannings = self._read_colle_plannings(colle_groups)
+
+        return sources
+
+    # Only the colles of `colle_groups` are decoded, each of them once, the
+    # whole section at once when every group is wanted
+    def _read_colle_plannings(self, colle_groups):
+        # Colle group -> indices of its colles in the colles section
+        colle_indices = {}
+        offset = self.offsets["colle_groups"]
+        group_count, = struct.unpack_from("<I", self.view, offset)
+        offset += 4
+        for _ in range(group_count):
+            colle_group, length = struct.unpack_from("<iI", self.view, offset)
+            offset += 8
+            if colle_groups is None or colle_group in colle_groups:
+                colle_indices[colle_group] = struct.unpack_from(
+                        f"<{length}I",
+                        self.view,
+                        offset
+                )
+            offset += 4 * length
 
-    return events
+        offset = self.offsets["colles"]
+        count, = struct.unpack_from("<I", self.view, offset)
+        columns, _ = self._read_columns(offset + 4, count)
+        if len(colle_indices) == group_count:
+            colles = self._get_records(columns)
+        else:
+            indices = sorted(set().union(*colle_indices.values()))
+            colles = dict(zip(indices, self._get_records([
+                [column[index] for index in indices] for column in columns
+            ])))
+
+        colle_plannings = {
+            colle_group: [colles[index] for index in indices]
+            for colle_group, indices in colle_indices.items()
+        }
+
+        if colle_groups is not None:
+            for colle_group in colle_groups:
+                colle_plannings.setdefault(colle_group, [])
+
+        return colle_plannings
+
+    def _read_record_lists(self, section):
+        offset = self.offsets[section]
+        count, = struct.unpack_from("<I", self.view, offset)
+        offset += 4
+
+        record_lists = []
+        for _ in range(count):
+            length, = struct.unpack_from("<I", self.view, offset)
+            columns, offset = self._read_columns(offset + 4, length)
+            record_lists.append(self._get_records(columns))
+
+        return record_lists
+
+    # Columns of the `count` records at `offset`, and the offset after them.
+    # Arrays rather than tuples, as the garbage collector would go through
+    # every item of the tuples while the records are built.
+    def _read_columns(self, offset, count):
+        columns = []
+        for code in _BUNDLE_COLUMNS:
+            column = array(code)
+            end = offset + count * struct.calcsize(f"<{code}")
+            column.frombytes(self.view[offset:end])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            offset = end
+        return columns, offset
+
+    # Records of decoded columns, each distinct time and date being only
+    # built once
+    def _get_records(self, columns):
+        starts, ends, ordinals, subjects, rooms, colleurs, groups = columns
+
+        for seconds in set(starts).union(ends).difference(self._times):
+            self._times[seconds] = time(
+                    seconds // 3600,
+                    seconds // 60 % 60,
+                    seconds % 60
+            )
+        for ordinal in set(ordinals).difference(self._dates):
+            self._dates[ordinal] = date.fromordinal(ordinal)
+
+        return list(map(
+                ScheduleRecord,
+                map(self._times.__getitem__, starts),
+                map(self._times.__getitem__, ends),
+                map(self._dates.__getitem__, ordinals),
+                map(self.strings.__getitem__, subjects),
+                map(self.strings.__getitem__, rooms),
+                map(self.strings.__getitem__, colleurs),
+                [group if group >= 0 else None for group in groups]
+        ))
+
+
+# Fills the missing keys of a job with `generate_schedule` defaults
+def _complete_job(job):
+    completed_job = {
+        "colle_group": None,
+        "static_group": None,
+        "output_filename": "schedule.ics",
+        "include_colles": False,
+        "include_schedule": False,
+        "include_room_planning": False,
+        "include_lv2": False,
+        "include_ds": True,
+        "recurring": False,
+        "start": None,
+        "end": None,
+        "occupancy": False,
+    }
+    completed_job.update(job)
+    return completed_job
 
 
-# Returns the day's lessons events
-def _get_day_lessons_events(event_date, day_schedule):
-    events = []
+def _write_schedule(
+        sources,
+        event_state,
+        output_filename="schedule.ics",
+        fragments=None,
+        **job
+):
+    with _atomic_open(output_filename) as f:
+        _write_schedule_calendar(
+                f,
+                sources,
+                event_state,
+                output_filename,
+                fragments,
+                **job
+        )
 
-    for start_time, end_time, header in day_schedule:
-        # Skip events without a name
-        if header:
-            # Combine date with time
-            start_datetime = PARIS_TZ.localize(
-                    datetime.combine(event_date, start_time))
-            end_datetime = PARIS_TZ.localize(
-                    datetime.combine(event_date, end_time))
 
-            headers = header.split('@')
-            summary = headers[0]
-            location = headers[1]
+# Writes the calendar of a job to `f`, `name` identifying it in the
+# profiling results. With `occupancy`, only the busy periods are written.
+def _write_schedule_calendar(
+        f,
+        sources,
+        event_state,
+        name,
+        fragments=None,
+        recurring=False,
+        occupancy=False,
+        **job
+):
+    if occupancy:
+        _write_freebusy(
+                f,
+                _get_schedule_events(sources, **job),
+                event_state,
+                _get_uid("occupation", _hash_job_options(job)),
+                name
+        )
+        return
+
+    # The series of the recurring mode may span several components
+    if fragments is None or recurring:
+        _write_calendar_events(
+                f,
+                _get_schedule_events(sources, recurring, **job),
+                event_state,
+                name
+        )
+        return
 
-            event = Event()
-            event.add('summary', summary)
-            event.add('dtstart', start_datetime)
-            event.add('dtend', end_datetime)
-            event.add('location', location)
-            event.add('dtstamp', datetime.now())
+    write_time = 0
+    event_count = 0
 
-            events.append(event)
+    start = perf_counter()
+    f.write(b"BEGIN:VCALENDAR\r\n")
+    write_time += perf_counter() - start
 
-    return events
+    for key, events in _get_schedule_components(sources, **job):
+        if key is None:
+            fragment, fragment_events = fragments.serialize(events(), name)
+        else:
+            fragment, fragment_events = fragments.get(key, events)
 
+        start = perf_counter()
+        f.write(fragment)
+        write_time += perf_counter() - start
+        event_count += fragment_events
 
-# Returns 2 if the two next weeks are vacation, else 0
-def _get_next_week_offset(current_week):
-    if current_week + 1 in VACATION_STARTING_WEEKS:
-        return 2
+    start = perf_counter()
+    f.write(b"END:VCALENDAR\r\n")
+    write_time += perf_counter() - start
 
-    return 0
+    _report_stage("write", name, write_time, event_count)
+
+
+# Returns the events of a job, see `generate_schedule` for the arguments
+def _get_schedule_events(sources, recurring=False, **job):
+    events = (
+        event
+        for _, component_events in _get_schedule_components(sources, **job)
+        for event in component_events()
+    )
+
+    if recurring:
+        events = compress_recurring_events(events)
+
+    return events
+
+
+# Returns the components of a job's calendar, see `get_calendar_components`
+def _get_schedule_components(
+        sources,
+        colle_group=None,
+        static_group=None,
+        include_colles=False,
+        include_schedule=False,
+        include_room_planning=False,
+        include_lv2=False,
+        include_ds=True,
+        start=None,
+        end=None
+):
+    colle_schedule = None
+
+    if include_colles:
+        if colle_group is None:
+            raise Exception("Colle groupe needed")
+        colle_schedule = sources.colle_plannings.get(colle_group, [])
+
+    if static_group is None:
+        if colle_group is None:
+            raise Exception("Colle groupe or Static group needed")
+        else:
+            static_group = _get_static_group(colle_group)
+
+    return get_calendar_components(
+            include_colles,
+            include_schedule,
+            include_room_planning,
+            colle_schedule,
+            sources.lesson_plannings,
+            sources.room_planning,
+            static_group,
+            include_lv2=include_lv2,
+            include_ds=include_ds,
+            ds_planning=sources.ds_planning,
+            start=start,
+            end=end
+    )
+
+
+# Serialized events of the calendar components shared by the calendars of a
+# run, such as the lessons of a static group or the DS, so that they are
+# serialized once and copied in every calendar. The DTSTAMP and SEQUENCE of
+# an event don't change during a run, so they are kept in the fragments.
+class FragmentCache:
+    def __init__(self, event_state):
+        self.event_state = event_state
+        # Component key -> (serialized events, event count)
+        self.fragments = {}
+
+    # Returns the serialized events of a component and their count, `events`
+    # building them
+    def get(self, key, events):
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            fragment = self.serialize(events(), f"fragment {key[0]}")
+            self.fragments[key] = fragment
+        return fragment
+
+    # Same as `get` for events that are not cached. `name` identifies them in
+    # the profiling results, which only time the serialization: the events
+    # are built, and profiled, by `events`.
+    def serialize(self, events, name):
+        if not _profile_hooks:
+            serialized_events = [
+                _serialize_event(event, self.event_state) for event in events
+            ]
+            return b"".join(serialized_events), len(serialized_events)
+
+        serialize_time = 0
+        serialized_events = []
+
+        for event in events:
+            start = perf_counter()
+            serialized_events.append(_serialize_event(event, self.event_state))
+            serialize_time += perf_counter() - start
+
+        _report_stage(
+                "serialize",
+                name,
+                serialize_time,
+                len(serialized_events)
+        )
+
+        return b"".join(serialized_events), len(serialized_events)
+
+
+# Yields the events of a colle group from the date `start` until the date
+# `end` (excluded), only building the teaching weeks in between. `include`
+# lists kinds of events among EVENT_KINDS. The sources are parsed if not
+# given, see `parse_sources`.
+def iter_events(
+        colle_group,
+        start,
+        end,
+        include=("colles", "schedule", "lv2", "ds"),
+        sources=None
+):
+    unknown_kinds = set(include) - set(EVENT_KINDS)
+    if unknown_kinds:
+        raise Exception(
+                "Types d'évènements inconnus : "
+                + ", ".join(sorted(unknown_kinds))
+        )
+
+    job = _complete_job({
+        "colle_group": colle_group,
+        "include_colles": "colles" in include,
+        "include_schedule": "schedule" in include,
+        "include_room_planning": "room" in include,
+        "include_lv2": "lv2" in include,
+        "include_ds": "ds" in include,
+        "start": start,
+        "end": end,
+    })
+    job.pop("output_filename")
+    job.pop("occupancy")
+
+    if sources is None:
+        sources = _parse_jobs_sources([job])
+
+    return _get_schedule_events(sources, **job)
+
+
+# Starts an HTTP server answering e.g. `/colle/7.ics` or
+# `/static/A.ics?lv2=1&ds=1` with calendars rendered on demand
+def serve(host="127.0.0.1", port=8000, cache_size=64):
+    server = make_server(host, port, cache_size)
+    print(f"Calendriers servis sur http://{host}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Same as `serve` but returns the server without starting it, `port` 0
+# picking any free port
+def make_server(host="127.0.0.1", port=8000, cache_size=64):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    handler = type(
+            "CalendarRequestHandler",
+            (_CalendarRequestHandler, BaseHTTPRequestHandler),
+            {}
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.renderer = CalendarRenderer(cache_size)
+    return server
+
+
+# Renders the calendars of jobs from the sources, parsed again only when
+# their files change, and keeps the last `cache_size` rendered calendars
+class CalendarRenderer:
+    def __init__(self, cache_size=64):
+        self.cache_size = cache_size
+        # (input hashes, options hash) -> (etag, body, gzipped body)
+        self.cache = OrderedDict()
+        self.event_state = EventState()
+        self.lock = threading.Lock()
+        # Filename -> (mtime, size, hash)
+        self._file_hashes = {}
+        # Source name -> (input hashes, parsed source)
+        self._parsed_sources = {}
+
+    # Returns the ETag, the body and the gzipped body of a job's calendar
+    def render(self, job):
+        job = _complete_job(job)
+        job.pop("output_filename")
+
+        with self.lock:
+            input_hashes = tuple(
+                self._hash_file(filename)
+                for filename in _get_job_inputs(job)
+            )
+            key = (input_hashes, _hash_job_options(job))
+
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+            sources = self._get_sources(job)
+            f = io.BytesIO()
+            _write_schedule_calendar(
+                    f,
+                    sources,
+                    self.event_state,
+                    "<mémoire>",
+                    **job
+            )
+            body = f.getvalue()
+            self.event_state.save()
+
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            rendered = (etag, body, gzip.compress(body))
+
+            self.cache[key] = rendered
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+            return rendered
+
+    def _get_sources(self, job):
+        bundle = self._get_bundle()
+        if bundle is not None:
+            return ScheduleSources(
+                    lesson_plannings=bundle.lesson_plannings
+                    if job["include_schedule"] else None,
+                    room_planning=bundle.room_planning
+                    if job["include_room_planning"] else None,
+                    ds_planning=bundle.ds_planning
+                    if job["include_ds"] else None,
+                    colle_plannings=bundle.colle_plannings
+                    if job["include_colles"] else None
+            )
+
+        sources = ScheduleSources()
+
+        if job["include_schedule"]:
+            sources.lesson_plannings = self._get_source(
+                    "schedule",
+                    [f"{index}.csv" for index in range(GROUP_COUNT)],
+                    parse_csv_schedule
+            )
+
+        if job["include_room_planning"]:
+            sources.room_planning = self._get_source(
+                    "room",
+                    ["room.csv"],
+                    parse_room_schedule
+            )
+
+        if job["include_ds"]:
+            sources.ds_planning = self._get_source(
+                    "ds",
+                    ["ds.csv"],
+                    parse_csv_ds
+            )
+
+        if job["include_colles"]:
+            sources.colle_plannings = self._get_source(
+                    "colles",
+                    ["collometre.csv"],
+                    build_collometre_index
+            )
+
+        return sources
+
+    # Returns the sources of the bundle, loaded again when it or one of its
+    # inputs changes, or None if there is no bundle or if it is stale
+    def _get_bundle(self):
+        filenames = [BUNDLE_FILENAME] + _get_bundle_inputs()
+        try:
+            input_hashes = tuple(
+                self._hash_file(filename) for filename in filenames
+            )
+        except FileNotFoundError:
+            return None
+
+        if "bundle" in self._parsed_sources:
+            previous_hashes, bundle = self._parsed_sources["bundle"]
+            if previous_hashes == input_hashes:
+                return bundle
+
+        bundle = load_bundle(
+                colle_groups=None,
+                file_hashes=dict(zip(filenames, input_hashes))
+        )
+        self._parsed_sources["bundle"] = (input_hashes, bundle)
+        return bundle
+
+    # Returns a parsed source, parsed again if one of its files changed
+    def _get_source(self, name, filenames, parse):
+        input_hashes = tuple(
+            self._hash_file(filename) for filename in filenames
+        )
+
+        if name in self._parsed_sources:
+            previous_hashes, source = self._parsed_sources[name]
+            if previous_hashes == input_hashes:
+                return source
+
+        source = parse()
+        self._parsed_sources[name] = (input_hashes, source)
+        return source
+
+    # Hashes a file again only when its modification time or size changed
+    def _hash_file(self, filename):
+        stat = os.stat(filename)
+        previous = self._file_hashes.get(filename)
+
+        if previous is not None \
+                and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+            return previous[2]
+
+        file_hash = _hash_file(filename, {})
+        self._file_hashes[filename] = (
+            stat.st_mtime_ns,
+            stat.st_size,
+            file_hash
+        )
+        return file_hash
+
+
+# Mixed with `BaseHTTPRequestHandler` by `make_server`
+class _CalendarRequestHandler:
+    def do_GET(self):
+        try:
+            job = _get_url_job(self.path)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if job is None:
+            self.send_error(404)
+            return
+
+        try:
+            etag, body, gzipped_body = self.server.renderer.render(job)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        # The gzipped body is a different representation, so it has its own
+        # strong ETag
+        if _accepts_gzip(self.headers.get('Accept-Encoding', "")):
+            body = gzipped_body
+            etag = etag[:-1] + '-gzip"'
+            content_encoding = 'gzip'
+        else:
+            content_encoding = None
+
+        if_none_match = self.headers.get('If-None-Match', "")
+        if etag in [tag.strip() for tag in if_none_match.split(',')] \
+                or if_none_match.strip() == "*":
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if content_encoding is not None:
+            self.send_header('Content-Encoding', content_encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Whether an Accept-Encoding header accepts gzip, that is if gzip, or else
+# "*", is listed without a zero qvalue
+def _accepts_gzip(accept_encoding):
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        name, *parameters = [part.strip() for part in coding.split(';')]
+        qvalue = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.lower()] = qvalue
+
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in qvalues:
+            return qvalues[name] > 0
+    return False
+
+
+# Returns the job of an URL, or None if it is not a calendar URL. Options
+# are query parameters: colles, schedule, room, lv2, ds and recurring, and
+# start and end (YYYY-MM-DD) or days (from start, today by default) to only
+# get the events of a period. Raises ValueError if the period is invalid.
+def _get_url_job(url):
+    parsed_url = urlparse(url)
+    match = re.fullmatch(r"/(colle|static)/(\w+)\.ics", parsed_url.path)
+    if match is None:
+        return None
+
+    kind, group = match.groups()
+    job = {"include_ds": False}
+
+    if kind == "colle":
+        if not group.isdigit() or int(group) not in COLLE_GROUPS:
+            return None
+        job["colle_group"] = int(group)
+        job["include_colles"] = True
+    else:
+        if group.upper() not in StaticGroup.__members__:
+            return None
+        job["static_group"] = StaticGroup[group.upper()]
+        job["include_schedule"] = True
+
+    query = parse_qs(parsed_url.query)
+    for parameter, key in (
+            ("colles", "include_colles"),
+            ("schedule", "include_schedule"),
+            ("room", "include_room_planning"),
+            ("lv2", "include_lv2"),
+            ("ds", "include_ds"),
+            ("recurring", "recurring"),
+            ("occupancy", "occupancy"),
+    ):
+        if parameter in query:
+            job[key] = query[parameter][-1].lower() in ("1", "true", "yes")
+
+    try:
+        if "start" in query:
+            job["start"] = date.fromisoformat(query["start"][-1])
+        if "end" in query:
+            job["end"] = date.fromisoformat(query["end"][-1])
+        elif "days" in query:
+            job["start"] = job.get("start", date.today())
+            job["end"] = job["start"] + timedelta(days=int(query["days"][-1]))
+    except (ValueError, OverflowError):
+        raise ValueError("Période invalide")
+
+    if "start" in job or "end" in job:
+        _get_window(job.get("start"), job.get("end"))
+
+    return job
+
+
+# Opens a temporary file next to `filename` and renames it to `filename` once
+# closed, so that readers never see a partially written calendar. The file
+# gets the permissions `open` would give it (0666 minus the umask), or those
+# of the file it replaces.
+@contextmanager
+def _atomic_open(filename):
+    directory, basename = os.path.split(os.path.abspath(filename))
+    temp_filename = os.path.join(
+            directory,
+            f".{basename}.{os.urandom(6).hex()}.tmp"
+    )
+    # Unlike tempfile.mkstemp, which creates files only readable by their
+    # owner, the umask applies
+    fd = os.open(
+            temp_filename,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+            0o666
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+
+        try:
+            os.chmod(temp_filename, os.stat(filename).st_mode & 0o777)
+        except FileNotFoundError:
+            pass
+
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+# A lesson, room slot, colle or DS as read by the parsers. The weekly
+# plannings (lessons and room) have no `date`, the day being their index in
+# the planning. `group` is the group occupying a room slot. The strings are
+# interned, as the same subjects, rooms and colleurs repeat all year long.
+ScheduleRecord = namedtuple(
+        'ScheduleRecord',
+        ['start_time', 'end_time', 'date', 'subject', 'room', 'colleur',
+         'group'],
+        defaults=(None, None, None, None, None)
+)
+
+
+# Parses the CSV schedules per group and returns a list of plannings per group
+def parse_csv_schedule():
+    return [
+        _parse_group_schedule(groupe_changeant_index)
+        for groupe_changeant_index in range(GROUP_COUNT)
+    ]
+
+
+# Parses the CSV schedule of a changing group
+def _parse_group_schedule(groupe_changeant_index):
+    planning = [[] for day in range(DAYS_IN_WEEK)]
+
+    filename = rf'{groupe_changeant_index}.csv'
+
+    # Open and read the CSV file
+    with _profile_stage("parse", filename), open(
+            filename,
+            newline='',
+            encoding='utf-8'
+    ) as csvfile:
+        csvreader = csv.reader(csvfile)
+        # Ignore the headers
+        _ = next(csvreader)
+
+        for row in csvreader:
+            for day in range(0, DAYS_IN_WEEK):
+                event = (row[0], row[day + 1])  # (hour, event)
+                planning[day].append(event)
+
+    with _profile_stage("group", filename):
+        return [
+            [
+                _get_lesson_record(start_time, end_time, header)
+                for start_time, end_time, header in day_schedule
+                # Skip events without a name
+                if header
+            ]
+            for day_schedule in _group_long_subjects(planning)
+        ]
+
+
+# Returns the record of a lesson, `header` being "subject@room"
+def _get_lesson_record(start_time, end_time, header):
+    headers = header.split('@')
+    return ScheduleRecord(
+            start_time,
+            end_time,
+            subject=sys.intern(headers[0]),
+            room=sys.intern(headers[1])
+    )
+
+
+def parse_csv_ds():
+    with _profile_stage("parse", "ds.csv"):
+        weeks = [[], [], [], []]  # On n'a pas de ds les premieres semaines
+        weeks += iter_ds_weeks()
+    return weeks
+
+
+# Yields the DS of every week of ds.csv while reading it
+def iter_ds_weeks():
+    with open("ds.csv", newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        # Extract the header
+        _ = next(reader)
+
+        # Function to parse date in the format "DD/MM/YY"
+        def parse_date(date_str):
+            return datetime.strptime(date_str, '%d/%m/%y')
+
+        # Process each row in the CSV
+        for row in reader:
+            # Handle "Vacances" or "Début S2"
+            if (not row[2]) and (not row[3]) and (not row[4]):
+                continue
+
+            # Calculate days for Monday
+            monday_date = parse_date(row[1]).date()
+
+            week_data = []
+
+            # Controle Lundi
+            if row[2]:
+                event = ScheduleRecord(
+                        time(16, 20),
+                        time(18, 15),
+                        monday_date,
+                        sys.intern(row[2])
+                )
+                week_data.append(event)
+            # Controle Mercredi
+            if row[3]:
+                wednesday_date = monday_date + timedelta(days=2)
+                event = ScheduleRecord(
+                        time(15, 15),
+                        time(18, 15),
+                        wednesday_date,
+                        sys.intern(row[3])
+                )
+                week_data.append(event)
+            # Controle lundi
+            if row[4]:
+                saturday_date = monday_date + timedelta(days=5)
+                event = ScheduleRecord(
+                        time(8, 0),
+                        time(12, 15),
+                        saturday_date,
+                        sys.intern(row[4])
+                )
+                week_data.append(event)
+
+            yield week_data
+
+
+def parse_room_schedule():
+    planning = [[] for day in range(DAYS_IN_WEEK)]
+
+    with _profile_stage("parse", "room.csv"), \
+            open("room.csv", newline='', encoding="utf-8") as csvfile:
+        reader = csv.reader(csvfile)
+
+        _ = next(reader)
+
+        for row in reader:
+            for day in range(DAYS_IN_WEEK):
+
+                event = ("", 0)
+                if row[day+1] not in ["1", "2", "3"]:
+                    event = (row[0], None)
+                else:
+                    event = (row[0], int(row[day + 1]) - 1)
+                logger.debug("Créneau de salle %s", event)
+                planning[day].append(event)
+
+    with _profile_stage("group", "room.csv"):
+        return [
+            [
+                ScheduleRecord(start_time, end_time, group=group)
+                for start_time, end_time, group in day_schedule
+                # Free slots
+                if group is not None
+            ]
+            for day_schedule in _group_long_subjects(planning)
+        ]
+
+
+def parse_collometre(colle_group):
+    return build_collometre_index().get(colle_group, [])
+
+
+# Reads the collometre once and returns a dict mapping every colle group to
+# its colles, with the dates and times already resolved
+def build_collometre_index():
+    index = {}
+
+    with _profile_stage("parse", "collometre.csv"):
+        for colle_groups, colle in _iter_collometre():
+            for g in colle_groups:
+                index.setdefault(g, []).append(colle)
+
+    return index
+
+
+# Yields the colles of a colle group while reading the collometre, without
+# keeping the colles of the other groups
+def iter_colles(colle_group):
+    for colle_groups, colle in _iter_collometre():
+        if colle_group in colle_groups:
+            yield colle
+
+
+# Yields (colle groups, colle) for every cell of the collometre
+def _iter_collometre():
+    grid = get_academic_grid()
+    # Strings are interned per file rather than with `sys.intern`, whose
+    # table would keep growing and shrinking while the colles are streamed
+    intern = {}.setdefault
+
+    with open("collometre.csv", newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+
+        _ = next(reader)
+        current_subject = ""
+
+        for row in reader:
+            # If the second colum is empty, it's a subject row
+            if not row[1]:
+                current_subject = row[0].strip()
+                current_subject = intern(current_subject, current_subject)
+                continue
+
+            colleur = row[0].strip()
+            colleur = intern(colleur, colleur)
+            colle_time = row[1].strip()
+            room = row[2].strip()
+            room = intern(room, room)
+
+            day_abbr, time_range = colle_time.split(' ')
+
+            if day_abbr not in DAY_ABBR_MAP:
+                continue  # Skip unknown day abbreviations
+            day_offset = DAY_ABBR_MAP[day_abbr]
+
+            start_time, end_time = _parse_colle_time_range(time_range)
+
+            # Iterate over the groups (skipping columns 0, 1, and 2)
+            for i, group in enumerate(row[3:], 3):
+                if not group:
+                    continue
+
+                colle = ScheduleRecord(
+                        start_time,
+                        end_time,
+                        grid.get_date(i - 3, day_offset),
+                        current_subject,
+                        room,
+                        colleur
+                )
+
+                # Handle multiple groups separated by '+', the same colle
+                # record is shared by all of them
+                yield {int(g) for g in group.split('+')}, colle
+
+
+# Parses a colle time range such as "17-18" or "12h15-13h15"
+@lru_cache(maxsize=None)
+def _parse_colle_time_range(time_range):
+    start_time_str, end_time_str = time_range.split('-')
+
+    # Determine if the time range uses 'h' format or not and parse
+    # accordingly
+    if 'h' in time_range:
+        # e.g. 12h15
+        time_format = '%Hh%M'
+    else:
+        # e.g. 12
+        time_format = '%H'
+
+    start_time = datetime.strptime(start_time_str, time_format).time()
+    end_time = datetime.strptime(end_time_str, time_format).time()
+
+    return start_time, end_time
+
+
+# An event as produced by the builders, only converted to iCalendar when
+# serialized, see `_serialize_event`. `rrule` is (interval, count) of a
+# weekly recurrence, `exdates` the excluded occurrences.
+CalendarEvent = namedtuple(
+        'CalendarEvent',
+        ['uid', 'summary', 'start', 'end', 'description', 'location',
+         'rrule', 'exdates'],
+        defaults=(None, None, None, ())
+)
+
+
+def get_calendar(
+        include_colles=True,
+        include_schedule=True,
+        include_room_schedule=False,
+        colle_planning=None,
+        lesson_plannings=None,
+        room_planning=None,
+        static_group=None,
+        include_lv2=False,
+        include_ds=False,
+        ds_planning=None,
+        start=None,
+        end=None
+):
+    from icalendar import Calendar
+
+    calendar = Calendar()
+    event_state = EventState(None)
+
+    for event in iter_calendar_events(
+            include_colles,
+            include_schedule,
+            include_room_schedule,
+            colle_planning,
+            lesson_plannings,
+            room_planning,
+            static_group,
+            include_lv2=include_lv2,
+            include_ds=include_ds,
+            ds_planning=ds_planning,
+            start=start,
+            end=end
+    ):
+        dtstamp, sequence = event_state.stamp(
+                event.uid,
+                _serialize_event_properties(event)
+        )
+        ical_event = _get_ical_event(event)
+        ical_event.add(
+                'dtstamp',
+                datetime.strptime(dtstamp, "%Y%m%dT%H%M%SZ")
+                .replace(tzinfo=timezone.utc)
+        )
+        ical_event.add('sequence', sequence)
+        calendar.add_component(ical_event)
+
+    return calendar
+
+
+# Converts a `CalendarEvent` to an icalendar `Event`
+def _get_ical_event(event):
+    from icalendar import Event
+
+    ical_event = Event()
+    ical_event.add('uid', event.uid)
+    ical_event.add('summary', event.summary)
+    ical_event.add('dtstart', event.start)
+    ical_event.add('dtend', event.end)
+
+    if event.description is not None:
+        ical_event.add('description', event.description)
+
+    if event.location is not None:
+        ical_event.add('location', event.location)
+
+    if event.rrule is not None:
+        interval, count = event.rrule
+        ical_event.add('rrule', {
+            'freq': 'weekly',
+            'interval': interval,
+            'count': count,
+        })
+
+    if event.exdates:
+        ical_event.add('exdate', list(event.exdates))
+
+    return ical_event
+
+
+# Same arguments as `get_calendar`, but yields the events one by one instead
+# of collecting them in a `Calendar`. With the dates `start` and `end`
+# (excluded), only the events overlapping them are built.
+def iter_calendar_events(
+        include_colles=True,
+        include_schedule=True,
+        include_room_schedule=False,
+        colle_planning=None,
+        lesson_plannings=None,
+        room_planning=None,
+        static_group=None,
+        include_lv2=False,
+        include_ds=False,
+        ds_planning=None,
+        start=None,
+        end=None
+):
+    components = get_calendar_components(
+            include_colles,
+            include_schedule,
+            include_room_schedule,
+            colle_planning,
+            lesson_plannings,
+            room_planning,
+            static_group,
+            include_lv2,
+            include_ds,
+            ds_planning,
+            start,
+            end
+    )
+
+    return (
+        event for _, events in components for event in events()
+    )
+
+
+# Same arguments as `iter_calendar_events`, but returns the components of
+# the calendar in the order their events are written, as (key, events)
+# pairs, `events` building the events of the component when called. The
+# components with the same key have the same events in every calendar, see
+# `FragmentCache`. The colles, specific to a colle group, have no key.
+def get_calendar_components(
+        include_colles=True,
+        include_schedule=True,
+        include_room_schedule=False,
+        colle_planning=None,
+        lesson_plannings=None,
+        room_planning=None,
+        static_group=None,
+        include_lv2=False,
+        include_ds=False,
+        ds_planning=None,
+        start=None,
+        end=None
+):
+    # Checked here rather than in the generator so that errors are raised
+    # before anything is written
+    if static_group is None:
+        raise Exception("Il faut un groupe statique")
+
+    if lesson_plannings is None and include_schedule:
+        raise Exception("Il faut un planning")
+
+    if colle_planning is None and include_colles:
+        raise Exception("Il faut un planning de colles")
+
+    if room_planning is None and include_room_schedule:
+        raise Exception("Il faut le planning de la salle")
+
+    window = None
+    weeks = range(WEEK_COUNT)
+    # Before the DS are filtered by the window
+    ds_planning_id = id(ds_planning)
+
+    if start is not None or end is not None:
+        start, end = window = _get_window(start, end)
+
+        if colle_planning is not None:
+            colle_planning = (
+                colle for colle in colle_planning
+                if start <= colle.date < end
+            )
+
+        if ds_planning is not None:
+            ds_planning = (
+                [ds for ds in week if start <= ds.date < end]
+                for week in ds_planning
+            )
+
+        # Only whole teaching weeks are built, the events of their days
+        # outside of the window are filtered afterwards
+        window_weeks = get_academic_grid().get_weeks(start, end)
+        weeks = range(window_weeks.start, min(window_weeks.stop, WEEK_COUNT))
+
+    components = []
+
+    if include_schedule or include_room_schedule:
+        components.append((
+            (
+                "weekly",
+                id(lesson_plannings),
+                id(room_planning),
+                static_group,
+                include_schedule,
+                include_room_schedule,
+                window,
+            ),
+            lambda: _iter_weekly_events(
+                    include_schedule,
+                    include_room_schedule,
+                    lesson_plannings,
+                    room_planning,
+                    static_group,
+                    weeks
+            )
+        ))
+
+    if include_colles:
+        components.append((
+            None,
+            lambda: _profile_iter(
+                    "build",
+                    "colle",
+                    _get_colle_events(colle_planning)
+            )
+        ))
+
+    if include_lv2:
+        components.append((
+            ("lv2", window),
+            lambda: _profile_iter("build", "lv2", _get_lv2_events(weeks))
+        ))
+
+    if include_ds:
+        components.append((
+            ("ds", ds_planning_id, window),
+            lambda: _profile_iter(
+                    "build",
+                    "ds",
+                    _get_DS_events(ds_planning)
+            )
+        ))
+
+    if window is not None:
+        components = [
+            (key, _get_window_events(events, *window))
+            for key, events in components
+        ]
+
+    return components
+
+
+# Period from `start` until `end` (excluded), a missing bound being the start
+# or the end of the year
+def _get_window(start, end):
+    grid = get_academic_grid()
+    start = start or grid.get_date(0, 0)
+    end = end or grid.get_date(WEEK_COUNT - 1, 6) + timedelta(days=1)
+    if start >= end:
+        raise ValueError("La fin de la période doit être après son début")
+    return start, end
+
+
+# Filters the events built by `events` to those starting from the date
+# `start` until the date `end` (excluded)
+def _get_window_events(events, start, end):
+    return lambda: (
+        event for event in events()
+        if start <= event.start.date() < end
+    )
+
+
+# Lessons and room events of the teaching weeks `weeks`, week after week
+def _iter_weekly_events(
+        include_schedule,
+        include_room_schedule,
+        lesson_plannings,
+        room_planning,
+        static_group,
+        weeks
+):
+    for current_week in weeks:
+        # Teaching weeks, vacation don't count in the changing group
+        # pattern
+        changing_group = _get_changing_group(static_group, current_week)
+
+        if include_schedule:
+            yield from _profile_iter(
+                    "build",
+                    "cours",
+                    _get_week_events(
+                        lesson_plannings[changing_group],
+                        changing_group,
+                        current_week
+                    )
+            )
+
+        if include_room_schedule:
+            yield from _profile_iter(
+                    "build",
+                    "salle",
+                    _get_week_room_events(
+                        room_planning,
+                        changing_group,
+                        current_week
+                    )
+            )
+
+
+# Writes the events to `output_filename` as soon as they are produced,
+# without building a `Calendar` nor the whole serialized file in memory
+def write_calendar_stream(events, output_filename, event_state=None):
+    with _atomic_open(output_filename) as f:
+        _write_calendar_events(f, events, event_state, output_filename)
+
+
+# Same as `write_calendar_stream` but returns the calendar as bytes
+def render_calendar(events, event_state=None):
+    f = io.BytesIO()
+    _write_calendar_events(f, events, event_state, "<mémoire>")
+    return f.getvalue()
+
+
+# Writes the periods when the events are busy, without their details, as
+# the FREEBUSY periods of a VFREEBUSY component. Overlapping or adjacent
+# events are merged in a single period.
+def write_freebusy(events, output_filename, event_state=None, uid=None):
+    with _atomic_open(output_filename) as f:
+        _write_freebusy(
+                f,
+                events,
+                event_state,
+                uid or _get_uid("occupation", output_filename),
+                output_filename
+        )
+
+
+def _write_freebusy(f, events, event_state, uid, name):
+    if event_state is None:
+        event_state = EventState(None)
+
+    # Built, and profiled, before the serialization is timed
+    intervals = [(event.start, event.end) for event in events]
+
+    start_time = perf_counter()
+    periods = _merge_busy_periods(intervals)
+
+    lines = [f"UID:{_escape_ical_text(uid)}"]
+    if periods:
+        lines.append("DTSTART:" + _format_utc_datetime(periods[0][0]))
+        lines.append("DTEND:" + _format_utc_datetime(periods[-1][1]))
+    lines += [
+        "FREEBUSY:" + _format_utc_datetime(start) + "/"
+        + _format_utc_datetime(end)
+        for start, end in periods
+    ]
+
+    properties = "".join(
+            _fold_ical_line(line) + "\r\n" for line in lines
+    ).encode('utf-8')
+    dtstamp, _ = event_state.stamp(uid, properties)
+    serialized_time = perf_counter()
+
+    f.write(
+        b"BEGIN:VCALENDAR\r\nBEGIN:VFREEBUSY\r\n"
+        + properties
+        + f"DTSTAMP:{dtstamp}\r\n".encode('utf-8')
+        + b"END:VFREEBUSY\r\nEND:VCALENDAR\r\n"
+    )
+
+    _report_stage(
+            "serialize",
+            name,
+            serialized_time - start_time,
+            len(intervals)
+    )
+    _report_stage("write", name, perf_counter() - serialized_time, 1)
+
+
+# Returns the busy periods of (start, end) intervals as sorted [start, end]
+# pairs, the overlapping or adjacent ones being merged
+def _merge_busy_periods(intervals):
+    periods = []
+
+    for start, end in sorted(intervals):
+        if periods and start <= periods[-1][1]:
+            periods[-1][1] = max(periods[-1][1], end)
+        else:
+            periods.append([start, end])
+
+    return periods
+
+
+# FREEBUSY periods have to be in UTC
+def _format_utc_datetime(value):
+    return value.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+# `name` identifies the calendar in the profiling results
+def _write_calendar_events(f, events, event_state, name):
+    if event_state is None:
+        event_state = EventState(None)
+
+    if _profile_hooks:
+        _write_profiled_calendar_events(f, events, event_state, name)
+        return
+
+    f.write(b"BEGIN:VCALENDAR\r\n")
+    for event in events:
+        f.write(_serialize_event(event, event_state))
+    f.write(b"END:VCALENDAR\r\n")
+
+
+# Same as `_write_calendar_events`, timing the serialization and the writes
+# apart from the building of the events
+def _write_profiled_calendar_events(f, events, event_state, name):
+    serialize_time = 0
+    write_time = 0
+    event_count = 0
+
+    start = perf_counter()
+    f.write(b"BEGIN:VCALENDAR\r\n")
+    write_time += perf_counter() - start
+
+    for event in events:
+        start = perf_counter()
+        serialized_event = _serialize_event(event, event_state)
+        serialized_time = perf_counter()
+        f.write(serialized_event)
+        written_time = perf_counter()
+
+        serialize_time += serialized_time - start
+        write_time += written_time - serialized_time
+        event_count += 1
+
+    start = perf_counter()
+    f.write(b"END:VCALENDAR\r\n")
+    write_time += perf_counter() - start
+
+    _report_stage("serialize", name, serialize_time, event_count)
+    _report_stage("write", name, write_time, event_count)
+
+
+def _serialize_event(event, event_state):
+    properties = _serialize_event_properties(event)
+    dtstamp, sequence = event_state.stamp(event.uid, properties)
+
+    return (
+        b"BEGIN:VEVENT\r\n"
+        + properties
+        + f"DTSTAMP:{dtstamp}\r\nSEQUENCE:{sequence}\r\n".encode('utf-8')
+        + b"END:VEVENT\r\n"
+    )
+
+
+# Serializes every property of an event but DTSTAMP and SEQUENCE
+def _serialize_event_properties(event):
+    lines = [
+        f"UID:{_escape_ical_text(event.uid)}",
+        f"SUMMARY:{_escape_ical_text(event.summary)}",
+        "DTSTART" + _format_ical_datetime(event.start),
+        "DTEND" + _format_ical_datetime(event.end),
+    ]
+
+    if event.description is not None:
+        lines.append(f"DESCRIPTION:{_escape_ical_text(event.description)}")
+
+    if event.location is not None:
+        lines.append(f"LOCATION:{_escape_ical_text(event.location)}")
+
+    if event.rrule is not None:
+        interval, count = event.rrule
+        lines.append(f"RRULE:FREQ=WEEKLY;COUNT={count};INTERVAL={interval}")
+
+    if event.exdates:
+        # All the dates share the parameters of the first
+        parameters, first_value = \
+            _format_ical_datetime(event.exdates[0]).split(':')
+        lines.append("EXDATE" + parameters + ':' + ','.join([first_value] + [
+            _format_ical_datetime(date).split(':')[1]
+            for date in event.exdates[1:]
+        ]))
+
+    return "".join(
+            _fold_ical_line(line) + "\r\n" for line in lines
+    ).encode('utf-8')
+
+
+# DTSTAMP and SEQUENCE of every event UID, kept between runs in `filename`
+# so that they only change when the event does. Without a file, nothing is
+# kept and every event is stamped now with the SEQUENCE 0, so that memory
+# does not grow with the number of events.
+class EventState:
+    def __init__(self, filename=EVENT_STATE_FILENAME):
+        self.filename = filename
+        # DTSTAMP of the events created or modified during this run
+        self.now = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        # UID -> [content hash, sequence, dtstamp]
+        self.events = {}
+        # Entries of `events` created or modified during this run
+        self.changed = {}
+
+        if filename is not None:
+            try:
+                with open(filename, encoding='utf-8') as f:
+                    self.events = json.load(f)
+            except FileNotFoundError:
+                pass
+
+    # Returns the DTSTAMP and SEQUENCE of an event given its serialized
+    # properties
+    def stamp(self, uid, properties):
+        if self.filename is None:
+            return self.now, 0
+
+        content_hash = hashlib.sha1(properties).hexdigest()
+        previous = self.events.get(uid)
+
+        if previous is not None and previous[0] == content_hash:
+            return previous[2], previous[1]
+
+        sequence = 0 if previous is None else previous[1] + 1
+        entry = [content_hash, sequence, self.now]
+        self.events[uid] = entry
+        self.changed[uid] = entry
+
+        return self.now, sequence
+
+    # Merges the changes made by another `EventState`, e.g. in a worker
+    def update(self, changed):
+        self.events.update(changed)
+        self.changed.update(changed)
+
+    def save(self):
+        if self.filename is None or not self.changed:
+            return
+
+        with _atomic_open(self.filename) as f:
+            f.write(json.dumps(self.events, sort_keys=True).encode('utf-8'))
+
+
+# Compares two generated calendars and returns the UIDs of the events that
+# were added, removed and modified, DTSTAMP and SEQUENCE being ignored
+def diff_calendars(old_filename, new_filename):
+    return _diff_events(
+            _read_calendar_events(old_filename),
+            _read_calendar_events(new_filename)
+    )
+
+
+def _diff_events(old_events, new_events):
+    return {
+        "added": sorted(new_events.keys() - old_events.keys()),
+        "removed": sorted(old_events.keys() - new_events.keys()),
+        "modified": sorted(
+            uid for uid in old_events.keys() & new_events.keys()
+            if old_events[uid] != new_events[uid]
+        ),
+    }
+
+
+# Prints the differences between two calendars, returns True if any
+def print_calendar_diff(old_filename, new_filename):
+    old_events = _read_calendar_events(old_filename)
+    new_events = _read_calendar_events(new_filename)
+    diff = _diff_events(old_events, new_events)
+
+    for symbol, key, events in (
+            ("+", "added", new_events),
+            ("-", "removed", old_events),
+            ("~", "modified", new_events),
+    ):
+        for uid in diff[key]:
+            properties = events[uid]
+            print(
+                f"{symbol} {properties.get('DTSTART', '')} "
+                f"{properties.get('SUMMARY', '')} ({uid})"
+            )
+
+    print(
+        f"{len(diff['added'])} ajouté(s), {len(diff['removed'])} supprimé(s), "
+        f"{len(diff['modified'])} modifié(s)"
+    )
+
+    return any(diff.values())
+
+
+# Reads the VEVENTs of a calendar as UID -> {property name: content line},
+# without DTSTAMP and SEQUENCE
+def _read_calendar_events(filename):
+    with open(filename, encoding='utf-8', newline='') as f:
+        # Unfold the content lines
+        content = re.sub(r"\r?\n[ \t]", "", f.read())
+
+    events = {}
+    properties = None
+
+    for line in content.splitlines():
+        if line == "BEGIN:VEVENT":
+            properties = {}
+        elif line == "END:VEVENT":
+            uid = properties.get('UID', "").partition(':')[2] \
+                or "\n".join(sorted(properties.values()))
+            events[uid] = properties
+            properties = None
+        elif properties is not None:
+            name = re.split(r"[;:]", line, maxsplit=1)[0].upper()
+            if name not in ('DTSTAMP', 'SEQUENCE'):
+                properties[name] = line
+
+    return events
+
+
+# Kinds of events of a student checked by `find_conflicts`, with their
+# `iter_calendar_events` option
+_CONFLICT_KINDS = [
+    ("cours", "include_schedule"),
+    ("colle", "include_colles"),
+    ("lv2", "include_lv2"),
+    ("ds", "include_ds"),
+]
+
+
+# Returns every pair of overlapping lessons, colles, LV2 and DS of each
+# colle group, as dicts ready to be saved as JSON. The sources are parsed if
+# not given.
+def find_conflicts(colle_groups=None, sources=None):
+    colle_groups = list(COLLE_GROUPS if colle_groups is None else colle_groups)
+    if sources is None:
+        sources = parse_sources(
+                colle_groups=colle_groups,
+                include_schedule=True,
+                include_room_planning=False,
+                include_ds=True
+        )
+
+    conflicts = []
+    for colle_group in colle_groups:
+        intervals = []
+        for kind, option in _CONFLICT_KINDS:
+            options = {
+                option_name: option_name == option
+                for _, option_name in _CONFLICT_KINDS
+            }
+            events = iter_calendar_events(
+                    colle_planning=sources.colle_plannings.get(
+                        colle_group,
+                        []
+                    ),
+                    lesson_plannings=sources.lesson_plannings,
+                    ds_planning=sources.ds_planning,
+                    static_group=_get_static_group(colle_group),
+                    **options
+            )
+            intervals += [
+                (event.start, event.end, (kind, event)) for event in events
+            ]
+
+        for first, second in _find_overlaps(intervals):
+            conflicts.append({
+                "colle_group": colle_group,
+                "events": [
+                    _get_conflict_event(*first),
+                    _get_conflict_event(*second),
+                ],
+            })
+
+    return conflicts
+
+
+# Yields the pairs of items of the (start, end, item) intervals that
+# overlap, sweeping over the intervals sorted by start while keeping the
+# ones not ended yet in a heap
+def _find_overlaps(intervals):
+    intervals = sorted(intervals, key=lambda interval: interval[:2])
+    # (end, index in `intervals`) of the intervals not ended yet
+    active = []
+
+    for index, (start, end, item) in enumerate(intervals):
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+
+        for _, other_index in active:
+            yield intervals[other_index][2], item
+
+        heapq.heappush(active, (end, index))
+
+
+def _get_conflict_event(kind, event):
+    return {
+        "kind": kind,
+        "summary": event.summary,
+        "start": event.start.isoformat(),
+        "end": event.end.isoformat(),
+        "uid": event.uid,
+    }
+
+
+# Checks the conflicts of every colle group and saves them as JSON in
+# `report_filename` (stdout if "-"). Returns the conflicts.
+def validate(report_filename="-"):
+    start = perf_counter()
+    conflicts = find_conflicts()
+    elapsed = perf_counter() - start
+
+    report = json.dumps(
+            {
+                "colle_groups": len(COLLE_GROUPS),
+                "conflict_count": len(conflicts),
+                "conflicts": conflicts,
+            },
+            indent=2,
+            ensure_ascii=False
+    )
+    if report_filename == "-":
+        print(report)
+    else:
+        with _atomic_open(report_filename) as f:
+            f.write(report.encode('utf-8'))
+
+    for conflict in conflicts:
+        first, second = conflict["events"]
+        print(
+            f"G{conflict['colle_group']} : {first['summary']} "
+            f"({first['start']}) chevauche {second['summary']} "
+            f"({second['start']})",
+            file=sys.stderr
+        )
+    print(
+        f"{len(conflicts)} conflit(s) en {elapsed:.3f}s",
+        file=sys.stderr
+    )
+
+    return conflicts
+
+
+# Replaces the events repeating every few weeks by one VEVENT per series
+# with a RRULE, and EXDATE for the weeks missing because of vacations. The
+# result is checked against the materialized events before being returned.
+def compress_recurring_events(events):
+    events = list(events)
+    # (summary, location, description, weekday, start, end) -> events
+    series = {}
+
+    for event in events:
+        series.setdefault(_get_series_key(event), []).append(event)
+
+    compact_events = []
+    for occurrences in series.values():
+        compact_events += _get_series_events(occurrences)
+
+    _check_recurring_equivalence(events, compact_events)
+
+    return compact_events
+
+
+# Estimated cost of an EXDATE compared to a whole VEVENT
+_EXDATE_COST = 0.25
+
+
+def _get_series_key(event):
+    start = event.start.replace(tzinfo=None)
+    end = event.end.replace(tzinfo=None)
+    return (
+        event.summary,
+        event.location,
+        event.description,
+        start.weekday(),
+        start.time(),
+        end - start,
+    )
+
+
+def _get_series_events(occurrences):
+    occurrences = sorted(occurrences, key=lambda event: event.start)
+    first_start = occurrences[0].start.replace(tzinfo=None)
+
+    # Week of every occurrence relative to the first one
+    weeks = [
+        (event.start.replace(tzinfo=None) - first_start).days // 7
+        for event in occurrences
+    ]
+
+    # Two events at the same time are kept as they are
+    if len(set(weeks)) != len(weeks):
+        return occurrences
+
+    if len(occurrences) == 1:
+        return occurrences
+
+    # Either a single series with the weeks in between excluded...
+    interval = reduce(gcd, weeks)
+    expanded_weeks = range(0, weeks[-1] + 1, interval)
+    excluded_weeks = sorted(set(expanded_weeks) - set(weeks))
+
+    # ...or one series per run of evenly spaced occurrences
+    runs = [[0]]
+    for index in range(1, len(weeks)):
+        run = runs[-1]
+        if len(run) == 1 or \
+                weeks[index] - weeks[run[-1]] == weeks[run[1]] - weeks[run[0]]:
+            run.append(index)
+        else:
+            runs.append([index])
+
+    if 1 + len(excluded_weeks) * _EXDATE_COST <= len(runs):
+        return [_get_recurring_event(
+                occurrences[0],
+                interval,
+                len(expanded_weeks),
+                excluded_weeks
+        )]
+
+    series_events = []
+    for run in runs:
+        if len(run) == 1:
+            series_events.append(occurrences[run[0]])
+            continue
+
+        series_events.append(_get_recurring_event(
+                occurrences[run[0]],
+                weeks[run[1]] - weeks[run[0]],
+                len(run),
+                []
+        ))
+
+    return series_events
+
+
+# The series has its own UID: with the UID of its first occurrence, the
+# event state would see that event change whenever the recurring and the
+# expanded calendars are generated in turn
+def _get_recurring_event(first_event, interval, count, excluded_weeks):
+    first_start = first_event.start
+    grid = get_academic_grid()
+
+    return first_event._replace(
+            uid=_get_uid("série", first_event.uid),
+            rrule=(interval, count),
+            exdates=tuple(
+                grid.localize(
+                    first_start.date() + timedelta(weeks=week),
+                    first_start.time()
+                )
+                for week in excluded_weeks
+            )
+    )
+
+
+# Expands the recurring events back and checks that they give exactly the
+# materialized events
+def _check_recurring_equivalence(events, compact_events):
+    expected = Counter(
+        _get_occurrence_key(event, event.start) for event in events
+    )
+    actual = Counter(
+        _get_occurrence_key(event, start)
+        for compact_event in compact_events
+        for event, start in _expand_recurring_event(compact_event)
+    )
+
+    if expected != actual:
+        raise Exception(
+                "Les évènements récurrents ne correspondent pas au calendrier "
+                f"complet ({len(expected - actual)} manquant(s), "
+                f"{len(actual - expected)} en trop)"
+        )
+
+
+# Compares occurrences on wall clock times, as the recurrences are expanded
+# in local time
+def _get_occurrence_key(event, start):
+    first_start = event.start.replace(tzinfo=None)
+    end = event.end.replace(tzinfo=None)
+    start = start.replace(tzinfo=None)
+    return (
+        event.summary,
+        event.location,
+        event.description,
+        start,
+        start + (end - first_start),
+    )
+
+
+# Yields (event, local start) for every occurrence of a weekly event
+def _expand_recurring_event(event):
+    if event.rrule is None:
+        yield event, event.start
+        return
+
+    interval, count = event.rrule
+    first_start = event.start.replace(tzinfo=None)
+
+    excluded = {date.replace(tzinfo=None) for date in event.exdates}
+
+    for index in range(count):
+        start = first_start + timedelta(weeks=index * interval)
+        if start not in excluded:
+            yield event, start
+
+
+# Returns the parameters and value of a DATE or DATE-TIME property, e.g.
+# ";TZID=Europe/Paris:20240916T080000"
+def _format_ical_datetime(value):
+    if not isinstance(value, datetime):
+        return value.strftime(";VALUE=DATE:%Y%m%d")
+
+    if value.tzinfo is None:
+        return value.strftime(":%Y%m%dT%H%M%S")
+
+    tzid = getattr(value.tzinfo, 'zone', None) \
+        or getattr(value.tzinfo, 'key', None)
+
+    if tzid is None or tzid == 'UTC':
+        return value.astimezone(timezone.utc).strftime(":%Y%m%dT%H%M%SZ")
+
+    return value.strftime(f";TZID={tzid}:%Y%m%dT%H%M%S")
+
+
+def _escape_ical_text(text):
+    return (
+        str(text)
+        .replace('\\', '\\\\')
+        .replace(';', '\\;')
+        .replace(',', '\\,')
+        .replace('\r\n', '\\n')
+        .replace('\n', '\\n')
+    )
+
+
+# Folds a content line in lines of at most 75 octets, without splitting
+# multi-octet UTF-8 characters (RFC 5545, section 3.1)
+def _fold_ical_line(line, limit=75):
+    if len(line.encode('utf-8')) <= limit:
+        return line
+
+    parts = []
+    current = []
+    current_size = 0
+    # Continuation lines start with a space
+    line_limit = limit
+
+    for char in line:
+        char_size = len(char.encode('utf-8'))
+        if current_size + char_size > line_limit:
+            parts.append("".join(current))
+            current = []
+            current_size = 0
+            line_limit = limit - 1
+        current.append(char)
+        current_size += char_size
+
+    parts.append("".join(current))
+
+    return "\r\n ".join(parts)
+
+
+def _get_lv2_events(weeks):
+    template = [WeekSlot(
+            LV2_HORAIRE["day_index"],
+            LV2_HORAIRE["start_time"],
+            LV2_HORAIRE["end_time"],
+            "lv2|",
+            "LV2",
+            None
+    )]
+
+    for current_week in weeks:
+        yield from _iter_week_template(template, current_week)
+
+def _get_DS_events(ds_planning):
+    grid = get_academic_grid()
+
+    for week in ds_planning:
+        for ds in week:
+            start_datetime = grid.localize(ds.date, ds.start_time)
+            end_datetime = grid.localize(ds.date, ds.end_time)
+
+            yield CalendarEvent(
+                    _get_uid("ds", start_datetime),
+                    f"[DS] {ds.subject}",
+                    start_datetime,
+                    end_datetime
+            )
+
+def _get_static_group(colle_group):
+    return STATIC_GROUPS[(colle_group + 2) % 3]
+
+
+# Functions called with (stage, source, seconds, event count) every time a
+# stage of the generation ends, see `add_profile_hook`
+_profile_hooks = []
+
+
+# Registers a function called with (stage, source, seconds, event count) at
+# the end of each stage: "parse" and "group" for every source file, "build"
+# for every kind of event ("cours", "salle", "colle", "lv2", "ds"),
+# "serialize" and "write" for every calendar
+def add_profile_hook(hook):
+    _profile_hooks.append(hook)
+
+
+def remove_profile_hook(hook):
+    _profile_hooks.remove(hook)
+
+
+# Hook summing the wall time, calls and events of every stage and source, to
+# be used as a context manager:
+#
+#   with Profiler() as profiler:
+#       generate_all()
+#   print(profiler.to_json())
+class Profiler:
+    def __init__(self):
+        # Stage -> {"seconds", "calls", "events", "sources": {source -> ...}}
+        self.stages = {}
+
+    def __call__(self, stage, source, seconds, events):
+        stage_stats = self.stages.setdefault(
+                stage,
+                {**_empty_profile_stats(), "sources": {}}
+        )
+        source_stats = stage_stats["sources"].setdefault(
+                source,
+                _empty_profile_stats()
+        )
+
+        for stats in (stage_stats, source_stats):
+            stats["seconds"] += seconds
+            stats["calls"] += 1
+            stats["events"] += events
+
+    def __enter__(self):
+        add_profile_hook(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_profile_hook(self)
+
+    def to_json(self):
+        return json.dumps({"stages": self.stages}, indent=2, sort_keys=True)
+
+    # Writes the JSON to `filename`, or to the standard output for "-"
+    def save(self, filename):
+        if filename == "-":
+            print(self.to_json())
+            return
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
+
+
+def _empty_profile_stats():
+    return {"seconds": 0.0, "calls": 0, "events": 0}
+
+
+def _report_stage(stage, source, seconds, events=0):
+    for hook in _profile_hooks:
+        hook(stage, source, seconds, events)
+
+
+# Reports the time spent in the block, if anyone listens
+@contextmanager
+def _profile_stage(stage, source):
+    if not _profile_hooks:
+        yield
+        return
+
+    start = perf_counter()
+    yield
+    _report_stage(stage, source, perf_counter() - start)
+
+
+# Reports the time spent producing the events of `events` and their count,
+# once it is exhausted, if anyone listens
+def _profile_iter(stage, source, events):
+    if not _profile_hooks:
+        return events
+
+    return _profiled_iter(stage, source, events)
+
+
+def _profiled_iter(stage, source, events):
+    elapsed = 0
+    count = 0
+    iterator = iter(events)
+
+    while True:
+        start = perf_counter()
+        try:
+            event = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += perf_counter() - start
+
+        count += 1
+        yield event
+
+    _report_stage(stage, source, elapsed, count)
+
+
+# Dates of the teaching weeks, vacations skipped, with a cache of the
+# localized datetimes so that each (day, time) is only localized once
+class AcademicGrid:
+    def __init__(
+            self,
+            start_date,
+            week_count,
+            vacation_starting_weeks,
+            vacation_lengths
+    ):
+        self.start_date = start_date.date() \
+            if isinstance(start_date, datetime) else start_date
+
+        # Calendar weeks that are vacation
+        self.vacation_weeks = set()
+        for starting_week in vacation_starting_weeks:
+            length = vacation_lengths.get(starting_week, 2)
+            self.vacation_weeks.update(
+                    range(starting_week, starting_week + length)
+            )
+
+        # Teaching week -> [date of each day of the week]
+        self.week_dates = []
+        # Teaching week -> date of its monday
+        self.mondays = []
+        self._next_calendar_week = 0
+        self._extend(week_count)
+
+        # (date, time) -> localized datetime
+        self._datetimes = {}
+
+    # Dates of the days of a teaching week
+    def get_week_dates(self, week):
+        if week < 0:
+            raise ValueError(f"Semaine négative : {week}")
+        if week >= len(self.week_dates):
+            self._extend(week + 1)
+        return self.week_dates[week]
+
+    # Date of a day of a teaching week
+    def get_date(self, week, day_index):
+        return self.get_week_dates(week)[day_index]
+
+    # Range of the teaching weeks with days from the date `start` until the
+    # date `end` (excluded)
+    def get_weeks(self, start, end):
+        return range(
+                bisect.bisect_right(self.mondays, start - timedelta(days=7)),
+                bisect.bisect_left(self.mondays, end)
+        )
+
+    # Localized datetime of a slot of a teaching week
+    def get_datetime(self, week, day_index, slot_time):
+        return self.localize(self.get_date(week, day_index), slot_time)
+
+    # Localized datetime of a slot at any date
+    def localize(self, slot_date, slot_time):
+        key = (slot_date, slot_time)
+        localized = self._datetimes.get(key)
+        if localized is None:
+            localized = localize(datetime.combine(slot_date, slot_time))
+            self._datetimes[key] = localized
+        return localized
+
+    # Adds teaching weeks until there are `week_count` of them
+    def _extend(self, week_count):
+        while len(self.week_dates) < week_count:
+            calendar_week = self._next_calendar_week
+            self._next_calendar_week += 1
+
+            if calendar_week in self.vacation_weeks:
+                continue
+
+            monday = self.start_date + timedelta(weeks=calendar_week)
+            self.week_dates.append([
+                monday + timedelta(days=day_index)
+                for day_index in range(7)
+            ])
+            self.mondays.append(monday)
+
+
+# Timezone of the current settings and these settings, see `get_timezone`
+_timezone = None
+_timezone_settings = None
+
+
+# Returns the timezone of the calendars, imported on first use
+def get_timezone():
+    global _timezone, _timezone_settings
+
+    settings = (TIMEZONE_NAME, TIMEZONE_BACKEND)
+    if _timezone is None or _timezone_settings != settings:
+        if TIMEZONE_BACKEND == "pytz":
+            import pytz
+            _timezone = pytz.timezone(TIMEZONE_NAME)
+        elif TIMEZONE_BACKEND == "zoneinfo":
+            from zoneinfo import ZoneInfo
+            _timezone = ZoneInfo(TIMEZONE_NAME)
+        else:
+            raise Exception(
+                    f"Bibliothèque de fuseaux horaires inconnue : "
+                    f"{TIMEZONE_BACKEND}"
+            )
+        _timezone_settings = settings
+
+    return _timezone
+
+
+# Localizes a naive datetime in the timezone of the calendars
+def localize(naive_datetime):
+    calendar_timezone = get_timezone()
+    # pytz timezones can't be given to `replace`
+    if hasattr(calendar_timezone, 'localize'):
+        return calendar_timezone.localize(naive_datetime)
+    return naive_datetime.replace(tzinfo=calendar_timezone)
+
+
+# PARIS_TZ, the timezone of the calendars before TIMEZONE_BACKEND existed,
+# is still available but only created on access
+def __getattr__(name):
+    if name == "PARIS_TZ":
+        return get_timezone()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Grid of the current settings and these settings, see `get_academic_grid`
+_academic_grid = None
+_academic_grid_settings = None
+
+
+# Returns the grid of the current settings, built once and rebuilt only if
+# the settings change
+def get_academic_grid():
+    global _academic_grid, _academic_grid_settings
+
+    settings = (
+        START_DATE,
+        WEEK_COUNT,
+        tuple(VACATION_STARTING_WEEKS),
+        tuple(sorted(VACATION_LENGTHS.items())),
+        TIMEZONE_NAME,
+        TIMEZONE_BACKEND,
+    )
+    if _academic_grid is None or _academic_grid_settings != settings:
+        _academic_grid = AcademicGrid(
+                START_DATE,
+                WEEK_COUNT,
+                VACATION_STARTING_WEEKS,
+                VACATION_LENGTHS
+        )
+        _academic_grid_settings = settings
+
+    return _academic_grid
+
+
+# Occupations of the room over all the teaching weeks, sorted so that the
+# occupations overlapping a period are found by bisection. The slots of the
+# room planning never overlap, so the ends are sorted as well as the starts.
+class RoomIndex:
+    def __init__(self, room_planning, week_count=None):
+        grid = get_academic_grid()
+        week_count = WEEK_COUNT if week_count is None else week_count
+
+        occupations = []
+        for week in range(week_count):
+            for day_index, day_schedule in enumerate(room_planning):
+                for slot in day_schedule:
+                    occupations.append((
+                        grid.get_datetime(week, day_index, slot.start_time),
+                        grid.get_datetime(week, day_index, slot.end_time),
+                        slot.group
+                    ))
+        occupations.sort()
+
+        self.starts = [start for start, _, _ in occupations]
+        self.ends = [end for _, end, _ in occupations]
+        self.groups = [group for _, _, group in occupations]
+
+    # Returns the (start, end, group) occupations overlapping [start, end),
+    # ignoring the occupations by `group` if given
+    def get_overlapping(self, start, end, group=None):
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_left(self.starts, end)
+
+        return [
+            (self.starts[i], self.ends[i], self.groups[i])
+            for i in range(first, last)
+            if group is None or self.groups[i] != group
+        ]
+
+    def is_free(self, start, end, group=None):
+        return not self.get_overlapping(start, end, group)
+
+    # Returns the (start, end) periods of at least `duration` during which
+    # the room is free on the day `day_index` of the teaching `weeks`,
+    # between `day_start` and `day_end`. The occupations by `group` are
+    # ignored if given, e.g. to find when a changing group can use the room.
+    def get_free_slots(
+            self,
+            weeks,
+            day_index,
+            duration,
+            group=None,
+            day_start=time(8, 0),
+            day_end=None
+    ):
+        grid = get_academic_grid()
+        day_end = day_end or END_TIME_MAP["last_hour"]
+
+        free_slots = []
+        for week in weeks:
+            free_start = grid.get_datetime(week, day_index, day_start)
+            closing = grid.get_datetime(week, day_index, day_end)
+
+            for start, end, _ in self.get_overlapping(
+                    free_start,
+                    closing,
+                    group
+            ):
+                if start - free_start >= duration:
+                    free_slots.append((free_start, start))
+                free_start = max(free_start, end)
+
+            if closing - free_start >= duration:
+                free_slots.append((free_start, closing))
+
+        return free_slots
+
+
+# Returns the index of the room planning, parsed if not given
+def build_room_index(room_planning=None):
+    if room_planning is None:
+        room_planning = parse_room_schedule()
+    return RoomIndex(room_planning)
+
+
+# Yields the free periods of the room as events, see
+# `RoomIndex.get_free_slots`
+def _get_free_room_events(free_slots):
+    for start, end in free_slots:
+        yield CalendarEvent(
+                _get_uid("salle libre", start, end),
+                "Salle libre",
+                start,
+                end
+        )
+
+
+# Yields the occupations of the room as events, see
+# `RoomIndex.get_overlapping`
+def _get_busy_room_events(occupations):
+    for start, end, group in occupations:
+        yield CalendarEvent(
+                _get_uid("salle occupée", group, start),
+                "Salle occuppée par G" + str(group+1),
+                start,
+                end
+        )
+
+
+# Gives the actual changing group given the current week
+def _get_changing_group(static_group, current_week):
+    static_to_changin_group_map = {
+        StaticGroup.A: ChangingGroup.G1,
+        StaticGroup.B: ChangingGroup.G2,
+        StaticGroup.C: ChangingGroup.G3,
+    }
+    return (static_to_changin_group_map[static_group].value - current_week) % 3
+
+
+# A lesson or room slot of a week template, relative to the monday of the
+# week. `uid_prefix` is the identity of the event without its start, see
+# `_get_uid`.
+WeekSlot = namedtuple(
+        'WeekSlot',
+        ['day_index', 'start_time', 'end_time', 'uid_prefix', 'summary',
+         'location']
+)
+
+# Week templates of the current plannings, see `_get_week_template`
+# (kind, changing group) -> (planning, template)
+_week_templates = {}
+
+
+# Returns the slots of the events of a week, built once per planning and
+# changing group. Only the dates change from one week to the other, see
+# `_iter_week_template`.
+def _get_week_template(kind, planning, changing_group):
+    cached = _week_templates.get((kind, changing_group))
+    if cached is not None and cached[0] is planning:
+        return cached[1]
+
+    if kind == "cours":
+        template = [
+            WeekSlot(
+                    day_index,
+                    lesson.start_time,
+                    lesson.end_time,
+                    f"cours|{changing_group}|",
+                    lesson.subject,
+                    lesson.room
+            )
+            for day_index, day_schedule in enumerate(planning)
+            for lesson in day_schedule
+        ]
+    else:
+        template = []
+        for day_index, day_schedule in enumerate(planning):
+            for slot in day_schedule:
+                if slot.group == changing_group:
+                    continue
+
+                logger.debug("Salle occupée par G%d", slot.group + 1)
+                template.append(WeekSlot(
+                        day_index,
+                        slot.start_time,
+                        slot.end_time,
+                        f"salle|{changing_group}|",
+                        "Salle occuppée par G" + str(slot.group+1),
+                        None
+                ))
+
+    _week_templates[(kind, changing_group)] = (planning, template)
+    return template
+
+
+# Yields the events of a week template in the teaching week `current_week`
+def _iter_week_template(template, current_week):
+    grid = get_academic_grid()
+    week_dates = grid.get_week_dates(current_week)
+
+    for slot in template:
+        slot_date = week_dates[slot.day_index]
+        start_datetime = grid.localize(slot_date, slot.start_time)
+
+        yield CalendarEvent(
+                _hash_uid(slot.uid_prefix + str(start_datetime)),
+                slot.summary,
+                start_datetime,
+                grid.localize(slot_date, slot.end_time),
+                location=slot.location
+        )
+
+
+# Yields all current week events
+def _get_week_events(planning, changing_group, current_week):
+    return _iter_week_template(
+            _get_week_template("cours", planning, changing_group),
+            current_week
+    )
+
+
+def _get_week_room_events(room_planning, changing_group, current_week):
+    return _iter_week_template(
+            _get_week_template("salle", room_planning, changing_group),
+            current_week
+    )
+
+
+# Yields colle events from a colle schedule
+def _get_colle_events(colle_schedule):
+    grid = get_academic_grid()
+
+    for colle in colle_schedule:
+        start_datetime = grid.localize(colle.date, colle.start_time)
+        end_datetime = grid.localize(colle.date, colle.end_time)
+
+        yield CalendarEvent(
+                _get_uid("colle", colle.colleur, start_datetime),
+                "[Colle] " + colle.subject,
+                start_datetime,
+                end_datetime,
+                description=f"Colleur: {colle.colleur}",
+                location=colle.room if colle.room != "" else None
+        )
+
+
+# Returns a UID derived from what identifies an event rather than from its
+# content, so that a modified event keeps its UID
+def _get_uid(*identity):
+    return _hash_uid("|".join(str(part) for part in identity))
+
+
+def _hash_uid(identity):
+    identity_hash = hashlib.sha1(identity.encode('utf-8')).hexdigest()
+    return f"{identity_hash}@csv-to-ical"
 
 
 # Groups longer lessons in a single event
@@ -662,14 +3746,429 @@ def _format_starting_time(starting_time):
     return datetime.strptime(starting_time, "%H:%M").time()
 
 
-if __name__ == '__main__':
-    #main()
+# Command line entry point, returns the exit code. Run with --help for the
+# commands.
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    # python csv_to_ical.py 7, as before the commands existed
+    if argv and argv[0].isdigit():
+        argv = ["occupied"] + argv
+
+    parser = _get_argument_parser()
+    args = parser.parse_args(argv)
+
+    # The colles of a static group would be those of several colle groups
+    if args.command is _run_generate and args.colles \
+            and args.colle_group is None:
+        parser.error("--colles nécessite --colle-group")
+
+    # Checked here so that an invalid period is a usage error rather than a
+    # traceback
+    if args.command is _run_query_events and args.end is None:
+        try:
+            args.end = args.start + timedelta(days=args.days)
+        except OverflowError:
+            parser.error("--days dépasse la dernière date possible")
+    if args.command in (_run_generate, _run_query_events) \
+            and (args.start is not None or args.end is not None):
+        try:
+            _get_window(args.start, args.end)
+        except ValueError as e:
+            parser.error(str(e))
+
+    logging.basicConfig(
+            level=args.log_level,
+            format="%(levelname)s %(name)s : %(message)s"
+    )
+
+    global TIMEZONE_BACKEND
+    TIMEZONE_BACKEND = args.timezone_backend
+
+    if args.profile is None:
+        return args.command(args)
+
+    with Profiler() as profiler:
+        try:
+            return args.command(args)
+        finally:
+            profiler.save(args.profile)
+
+
+def _get_argument_parser():
+    parser = argparse.ArgumentParser(
+            description="Convertit les fichiers CSV en fichiers iCalendar."
+    )
+    parser.add_argument(
+            "--profile",
+            nargs='?',
+            const="-",
+            metavar="FICHIER",
+            help="enregistre le temps passé dans chaque étape en JSON"
+    )
+    parser.add_argument(
+            "--log-level",
+            type=str.upper,
+            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+            default="WARNING"
+    )
+    parser.add_argument(
+            "--timezone-backend",
+            choices=["pytz", "zoneinfo"],
+            default=TIMEZONE_BACKEND
+    )
+    commands = parser.add_subparsers(metavar="COMMANDE", required=True)
+
+    command = commands.add_parser(
+            "generate",
+            help="génère le calendrier d'un groupe"
+    )
+    group = command.add_mutually_exclusive_group(required=True)
+    group.add_argument("--colle-group", type=_colle_group_argument)
+    group.add_argument("--static-group", type=_static_group_argument)
+    _add_include_arguments(command)
+    command.add_argument("--recurring", action="store_true")
+    command.add_argument("--start", type=date.fromisoformat)
+    command.add_argument("--end", type=date.fromisoformat)
+    command.add_argument("--occupancy", action="store_true",
+                         help="n'écrit que les périodes occupées")
+    command.add_argument("-o", "--output", default="schedule.ics")
+    command.set_defaults(command=_run_generate)
+
+    command = commands.add_parser(
+            "occupied",
+            help="génère les périodes occupées d'un groupe de colle, par "
+                 "défaut pendant les DS"
+    )
+    command.add_argument("colle_group", type=_colle_group_argument)
+    _add_include_arguments(command)
+    command.set_defaults(command=_run_occupied)
+
+    command = commands.add_parser(
+            "batch",
+            help="génère les calendriers de tous les groupes"
+    )
+    command.add_argument("--colles", action="store_true")
+    command.add_argument("--no-schedule", action="store_true")
+    command.add_argument("--room", action="store_true")
+    command.add_argument("--workers", type=int,
+                         help="nombre de processus")
+    command.add_argument("--incremental", action="store_true",
+                         help="ne regénère que les calendriers modifiés")
+    command.set_defaults(command=_run_batch)
+
+    command = commands.add_parser(
+            "classes",
+            help="génère les calendriers de chaque dossier de classe"
+    )
+    command.add_argument("directory")
+    command.add_argument("-o", "--output",
+                         help="dossier des calendriers, ceux des classes "
+                              "par défaut")
+    command.add_argument("--workers", type=int,
+                         help="nombre de processus")
+    command.set_defaults(command=_run_classes)
+
+    command = commands.add_parser(
+            "publish",
+            help="publie les calendriers de tous les groupes pour un serveur "
+                 "de fichiers statiques"
+    )
+    command.add_argument("directory", nargs='?', default=".")
+    command.add_argument("--colles", action="store_true")
+    command.add_argument("--no-schedule", action="store_true")
+    command.add_argument("--room", action="store_true")
+    command.add_argument("--workers", type=int,
+                         help="nombre de fils de compression")
+    command.set_defaults(command=_run_publish)
+
+    command = commands.add_parser(
+            "compile",
+            help="compile les CSV en un bundle chargé à leur place"
+    )
+    command.add_argument("-o", "--output", default=BUNDLE_FILENAME)
+    command.set_defaults(command=_run_compile)
+
+    command = commands.add_parser(
+            "validate",
+            help="cherche les chevauchements de chaque groupe de colle"
+    )
+    command.add_argument("--report", default="-",
+                         help="rapport JSON, sur la sortie standard par "
+                              "défaut")
+    command.set_defaults(command=_run_validate)
+
+    command = commands.add_parser("query", help="interroge les plannings")
+    queries = command.add_subparsers(metavar="REQUÊTE", required=True)
+
+    query = queries.add_parser(
+            "group",
+            help="groupes statique et changeant d'un groupe de colle"
+    )
+    query.add_argument("colle_group", type=_colle_group_argument)
+    query.set_defaults(command=_run_query_group)
+
+    query = queries.add_parser(
+            "events",
+            help="évènements d'un groupe de colle sur une période"
+    )
+    query.add_argument("colle_group", type=_colle_group_argument)
+    query.add_argument("--start", type=date.fromisoformat,
+                       default=date.today())
+    period = query.add_mutually_exclusive_group()
+    period.add_argument("--end", type=date.fromisoformat)
+    period.add_argument("--days", type=int, default=7)
+    _add_include_arguments(query)
+    query.add_argument("-o", "--output", help="calendrier à générer")
+    query.set_defaults(command=_run_query_events)
+
+    query = queries.add_parser(
+            "room-free",
+            help="périodes où la salle est libre"
+    )
+    query.add_argument("day", choices=list(DAY_ABBR_MAP))
+    query.add_argument("minutes", type=int)
+    query.add_argument("first_week", type=_week_argument)
+    query.add_argument("last_week", type=_week_argument)
+    query.add_argument("-o", "--output", help="calendrier à générer")
+    query.set_defaults(command=_run_query_room_free)
+
+    query = queries.add_parser(
+            "room-busy",
+            help="occupations de la salle"
+    )
+    query.add_argument("first_week", type=_week_argument)
+    query.add_argument("last_week", type=_week_argument)
+    query.add_argument("-o", "--output", help="calendrier à générer")
+    query.set_defaults(command=_run_query_room_busy)
+
+    command = commands.add_parser(
+            "diff",
+            help="compare deux calendriers"
+    )
+    command.add_argument("old")
+    command.add_argument("new")
+    command.set_defaults(command=_run_diff)
+
+    command = commands.add_parser(
+            "serve",
+            help="sert les calendriers en HTTP"
+    )
+    command.add_argument("port", type=int, nargs='?', default=8000)
+    command.add_argument("--host", default="127.0.0.1")
+    command.set_defaults(command=_run_serve)
+
+    command = commands.add_parser(
+            "watch",
+            help="regénère les calendriers quand les CSV changent"
+    )
+    command.set_defaults(command=_run_watch)
+
+    return parser
+
+
+# --colles, --schedule, --room, --lv2 and --no-ds
+def _add_include_arguments(parser):
+    parser.add_argument("--colles", action="store_true")
+    parser.add_argument("--schedule", action="store_true")
+    parser.add_argument("--room", action="store_true")
+    parser.add_argument("--lv2", action="store_true")
+    parser.add_argument("--no-ds", action="store_true")
+
+
+def _colle_group_argument(value):
+    first, last = COLLE_GROUPS[0], COLLE_GROUPS[-1]
+    try:
+        colle_group = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                f"Veuillez entrer un nombre entier entre {first} et {last}."
+        )
+
+    if colle_group not in COLLE_GROUPS:
+        raise argparse.ArgumentTypeError(
+                f"Le numéro groupe doit être compris entre {first} et {last} "
+                "inclus."
+        )
+
+    return colle_group
+
+
+def _week_argument(value):
+    try:
+        week = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                "Veuillez entrer un numéro de semaine entier."
+        )
+
+    if week < 0:
+        raise argparse.ArgumentTypeError(
+                "Le numéro de semaine doit être positif ou nul."
+        )
+
+    return week
+
+
+def _static_group_argument(value):
+    if value.upper() not in StaticGroup.__members__:
+        raise argparse.ArgumentTypeError(f"Groupe statique inconnu : {value}")
+    return StaticGroup[value.upper()]
+
+
+def _run_generate(args):
     generate_schedule(
-            static_group=StaticGroup.C,
-            output_filename=f"schedule_ds.ics",
-            include_colles=False,
-            include_schedule=False,
-            include_room_planning=False,
-            include_lv2=False,
-            include_ds=True
+            colle_group=args.colle_group,
+            static_group=args.static_group,
+            output_filename=args.output,
+            include_colles=args.colles,
+            include_schedule=args.schedule,
+            include_room_planning=args.room,
+            include_lv2=args.lv2,
+            include_ds=not args.no_ds,
+            recurring=args.recurring,
+            start=args.start,
+            end=args.end,
+            occupancy=args.occupancy
+    )
+    return 0
+
+
+def _run_occupied(args):
+    generate_occupied(
+            args.colle_group,
+            include_colles=args.colles,
+            include_schedule=args.schedule,
+            include_room_planning=args.room,
+            include_lv2=args.lv2,
+            include_ds=not args.no_ds
+    )
+    return 0
+
+
+def _run_batch(args):
+    jobs = _get_all_jobs(args.colles, not args.no_schedule, args.room)
+
+    if args.incremental:
+        generate_incremental(jobs)
+        return 0
+
+    if args.workers is not None:
+        return 1 if generate_parallel(jobs, args.workers)["failures"] else 0
+
+    generate_batch(jobs)
+    return 0
+
+
+def _run_classes(args):
+    failures = generate_classes(args.directory, args.output, args.workers)
+    return 1 if failures else 0
+
+
+def _run_publish(args):
+    publish(
+            _get_all_jobs(args.colles, not args.no_schedule, args.room),
+            args.directory,
+            args.workers
+    )
+    return 0
+
+
+def _run_compile(args):
+    compile_bundle(args.output)
+    print(f"Bundle écrit dans {args.output}")
+    return 0
+
+
+def _run_validate(args):
+    return 1 if validate(args.report) else 0
+
+
+def _run_query_group(args):
+    static_group = _get_static_group(args.colle_group)
+    grid = get_academic_grid()
+
+    print(f"Groupe de colle {args.colle_group} : "
+          f"groupe statique {static_group.name}")
+    for week in range(WEEK_COUNT):
+        changing_group = _get_changing_group(static_group, week)
+        print(f"Semaine {week} ({grid.get_date(week, 0):%d/%m/%Y}) : "
+              f"G{changing_group + 1}")
+    return 0
+
+
+def _run_query_events(args):
+    include = [
+        kind for kind, selected in (
+            ("colles", args.colles),
+            ("schedule", args.schedule),
+            ("room", args.room),
+            ("lv2", args.lv2),
+            ("ds", not args.no_ds),
+        )
+        if selected
+    ]
+    events = iter_events(args.colle_group, args.start, args.end, include)
+
+    if args.output is not None:
+        event_state = EventState()
+        write_calendar_stream(events, args.output, event_state)
+        event_state.save()
+        return 0
+
+    for event in sorted(events, key=lambda event: event.start):
+        print(f"{event.start:%d/%m/%Y %H:%M} - {event.end:%H:%M} "
+              f"{event.summary}")
+    return 0
+
+
+def _run_query_room_free(args):
+    free_slots = build_room_index().get_free_slots(
+            range(args.first_week, args.last_week + 1),
+            DAY_ABBR_MAP[args.day],
+            timedelta(minutes=args.minutes)
+    )
+    for start, end in free_slots:
+        print(f"{start:%d/%m/%Y %H:%M} - {end:%H:%M}")
+
+    if args.output is not None:
+        write_calendar_stream(_get_free_room_events(free_slots), args.output)
+    return 0
+
+
+def _run_query_room_busy(args):
+    grid = get_academic_grid()
+    occupations = build_room_index().get_overlapping(
+            grid.get_datetime(args.first_week, 0, time(0, 0)),
+            grid.get_datetime(args.last_week + 1, 0, time(0, 0))
     )
+    for start, end, group in occupations:
+        print(f"{start:%d/%m/%Y %H:%M} - {end:%H:%M} G{group + 1}")
+
+    if args.output is not None:
+        write_calendar_stream(
+                _get_busy_room_events(occupations),
+                args.output
+        )
+    return 0
+
+
+def _run_diff(args):
+    return 1 if print_calendar_diff(args.old, args.new) else 0
+
+
+def _run_serve(args):
+    serve(args.host, args.port)
+    return 0
+
+
+def _run_watch(args):
+    try:
+        watch(_get_all_jobs(True, True, False))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())